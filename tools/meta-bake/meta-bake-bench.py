@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# Copyright(c) 2023, Intel Corporation
+#
+# Redistribution  and  use  in source  and  binary  forms,  with  or  without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of  source code  must retain the  above copyright notice,
+#   this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name  of Intel Corporation  nor the names of its contributors
+#   may be used to  endorse or promote  products derived  from this  software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING,  BUT NOT LIMITED TO,  THE
+# IMPLIED WARRANTIES OF  MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT  SHALL THE COPYRIGHT OWNER  OR CONTRIBUTORS BE
+# LIABLE  FOR  ANY  DIRECT,  INDIRECT,  INCIDENTAL,  SPECIAL,  EXEMPLARY,  OR
+# CONSEQUENTIAL  DAMAGES  (INCLUDING,  BUT  NOT LIMITED  TO,  PROCUREMENT  OF
+# SUBSTITUTE GOODS OR SERVICES;  LOSS OF USE,  DATA, OR PROFITS;  OR BUSINESS
+# INTERRUPTION)  HOWEVER CAUSED  AND ON ANY THEORY  OF LIABILITY,  WHETHER IN
+# CONTRACT,  STRICT LIABILITY,  OR TORT  (INCLUDING NEGLIGENCE  OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,  EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''Benchmark the orchestration overhead of meta-bake.py without a real build.
+
+git, bitbake, fcs_prepare and quartus_sign are replaced with stand-ins that
+sleep for a configurable time and produce realistic outputs (local git
+repos, a multi-MB bitbake -e dump, signed certificates), so the numbers
+reflect meta-bake's own work: repo sync, conf rewriting, env parsing,
+artifact staging, signing orchestration and premirror refreshes.
+Everything runs offline in a scratch directory.
+'''
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+LOG = logging.getLogger('meta-bake-bench')
+
+FAKE_GIT = '''
+#!/bin/bash
+sleep {delay}
+exec {git} "$@"
+'''.strip()
+
+FAKE_OE_INIT_BUILD_ENV = '''
+mkdir -p $1/conf
+touch $1/conf/local.conf $1/conf/bblayers.conf
+cd $1
+'''.strip()
+
+FAKE_BITBAKE = '''
+#!/bin/bash
+sleep {delay}
+if [ "$1" = "-e" ]; then
+  exec cat {env_dump}
+fi
+'''.strip()
+
+FAKE_FCS_PREPARE = '''
+#!/bin/bash
+sleep {delay}
+case "$1" in
+  --hps_cert) sha256sum "$2" > unsigned_cert.ccert ;;
+  --finish) cat "$2" "$4" > hps_image_signed.vab ;;
+  --version) echo fcs_prepare-bench ;;
+esac
+'''.strip()
+
+FAKE_QUARTUS_SIGN = '''
+#!/bin/bash
+if [ "$1" = "--version" ]; then
+  echo quartus_sign-bench
+  exit 0
+fi
+sleep {delay}
+cp "${{@: -2:1}}" "${{@: -1}}"
+'''.strip()
+
+
+def load_meta_bake():
+    path = Path(__file__).absolute().parent.joinpath('meta-bake.py')
+    spec = importlib.util.spec_from_file_location('meta_bake', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_tool(path: Path, text: str):
+    path.write_text(text + '\n')
+    path.chmod(0o755)
+
+
+def write_env_dump(path: Path, size_mb: float, wanted: dict):
+    '''Write a bitbake -e style dump of about size_mb MB.
+
+    The dump has the same shape as the real thing: a history comment block
+    per variable, quoted and exported assignments, values continued over
+    several lines and shell functions. The variables meta-bake looks for are
+    spread through the dump rather than grouped at the start.
+    '''
+    size = int(size_mb * (1 << 20))
+    positions = {int(size * (i + 1) / (len(wanted) + 1)): item
+                 for i, item in enumerate(wanted.items())}
+    written = 0
+    n = 0
+    with path.open('w') as fp:
+        while written < size:
+            n += 1
+            if n % 50 == 0:
+                chunk = (f'# line: {n}, file: /poky/meta/classes/base.bbclass\n'
+                         f'do_task_{n}() {{\n'
+                         f'\toe_runmake -C ${{B}} install DESTDIR=${{D}}\n'
+                         f'\tinstall -d ${{D}}/usr/share/task{n}\n'
+                         '}\n\n')
+            elif n % 7 == 0:
+                chunk = (f'# $FLAGS_{n} [2 operations]\n'
+                         f'#   set /poky/meta/conf/bitbake.conf:{n}\n'
+                         f'FLAGS_{n}="-O2 -pipe \\\n    -feliminate-unused-debug-types \\\n'
+                         f'    -fmacro-prefix-map=/build/{n}=/usr/src/debug"\n\n')
+            else:
+                chunk = (f'# $VAR_{n} [1 operations]\n'
+                         f'#   set /poky/meta/conf/bitbake.conf:{n}\n'
+                         f'#     "/build/tmp/work/value-{n}"\n'
+                         f'# pre-expansion value:\n'
+                         f'#   "${{TMPDIR}}/work/value-{n}"\n'
+                         f'{"export " if n % 5 == 0 else ""}VAR_{n}="/build/tmp/work/value-{n}"\n\n')
+            for position in [p for p in positions if p <= written]:
+                name, value = positions.pop(position)
+                chunk += f'# ${name}\n{name}="{value}"\n\n'
+            fp.write(chunk)
+            written += len(chunk)
+
+
+class bench:
+    '''Scratch area with the stand-in tools on PATH and the timing helpers.'''
+
+    def __init__(self, mb, args: argparse.Namespace, workdir: Path):
+        self.mb = mb
+        self.args = args
+        self.workdir = workdir
+        self.bin_dir = workdir.joinpath('bin')
+        self.bin_dir.mkdir()
+        self.results = []
+        git = shutil.which('git')
+        if git is None:
+            raise SystemExit('git is needed for the sync benchmark')
+        write_tool(self.bin_dir.joinpath('git'), FAKE_GIT.format(delay=args.git_delay, git=git))
+        self.env_dump = workdir.joinpath('env-dump.txt')
+        self.wanted = {'S': '/build/tmp/work/u-boot/git',
+                       'B': '/build/tmp/work/u-boot/build',
+                       'DEPLOY_DIR_IMAGE': '/build/tmp/deploy/images/agilex',
+                       'IMAGE_BASENAME': 'core-image-minimal'}
+        write_env_dump(self.env_dump, args.env_mb, self.wanted)
+        write_tool(self.bin_dir.joinpath('bitbake'),
+                   FAKE_BITBAKE.format(delay=args.bitbake_delay, env_dump=self.env_dump))
+        write_tool(self.bin_dir.joinpath('fcs_prepare'),
+                   FAKE_FCS_PREPARE.format(delay=args.sign_delay / 2))
+        write_tool(self.bin_dir.joinpath('quartus_sign'),
+                   FAKE_QUARTUS_SIGN.format(delay=args.sign_delay))
+        self.poky_dir = workdir.joinpath('poky')
+        self.poky_dir.mkdir()
+        self.poky_dir.joinpath('oe-init-build-env').write_text(FAKE_OE_INIT_BUILD_ENV + '\n')
+        os.environ['PATH'] = f'{self.bin_dir}:{os.environ["PATH"]}'
+
+    def measure(self, name: str, func, setup=None):
+        times = []
+        for _ in range(self.args.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        # tracemalloc slows down every allocation, so measure memory in a run of its own
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.results.append({'name': name,
+                             'repeat': len(times),
+                             'min': min(times),
+                             'mean': statistics.mean(times),
+                             'peak_kb': peak // 1024})
+
+    def namespace(self, build_dir: Path, **kwargs) -> argparse.Namespace:
+        values = {'build_dir': build_dir, 'keep': [], 'git_mirror': None,
+                  'mirror_refresh': None, 'sync_jobs': self.args.jobs}
+        values.update(kwargs)
+        return argparse.Namespace(**values)
+
+    def sync(self):
+        origins = self.workdir.joinpath('origins')
+        repos = []
+        for i in range(self.args.repos):
+            origin = origins.joinpath(f'layer-{i}')
+            origin.mkdir(parents=True)
+            for cmd in (['git', 'init', '-q', '-b', 'master'],
+                        ['git', 'config', 'user.email', 'bench@localhost'],
+                        ['git', 'config', 'user.name', 'bench']):
+                subprocess.check_call(cmd, cwd=origin)
+            for n in range(self.args.files // 10 or 1):
+                origin.joinpath(f'recipe-{n}.bb').write_text(f'SRCREV = "{n:040d}"\n' * 20)
+            subprocess.check_call(['git', 'add', '.'], cwd=origin)
+            subprocess.check_call(['git', 'commit', '-q', '-m', 'initial'], cwd=origin)
+            repos.append({'name': f'layer-{i}', 'url': str(origin), 'branch': 'master'})
+
+        build_dir = self.workdir.joinpath('sync')
+
+        def clean():
+            shutil.rmtree(build_dir, ignore_errors=True)
+            build_dir.mkdir()
+
+        args = self.namespace(build_dir)
+        self.measure('sync clone', lambda: self.mb.get_meta({'repos': repos}, args), clean)
+        self.measure('sync update', lambda: self.mb.get_meta({'repos': repos}, args))
+
+    def conf(self):
+        build_dir = self.workdir.joinpath('conf')
+        rootfs_dir = build_dir.joinpath('rootfs')
+        local_conf = rootfs_dir.joinpath('conf', 'local.conf')
+        local_conf.parent.mkdir(parents=True)
+        base = ''.join(f'#\n# setting {n}\n#\nSETTING_{n} = "value-{n}"\n'
+                       for n in range(self.args.conf_lines))
+        cfg = {'local': {'remove': [f'SETTING_{n}' for n in range(0, self.args.conf_lines, 3)],
+                         'values': {f'NEW_{n}': f'${{build_dir}}/new-{n}'
+                                    for n in range(self.args.conf_lines // 10)}}}
+        ctx = {'build_dir': str(build_dir)}
+        bb = self.mb.bitbaker(self.poky_dir, rootfs_dir, build_dir)
+        self.measure('conf rewrite', lambda: bb.update_local_conf(cfg, ctx),
+                     lambda: local_conf.write_text(base))
+        self.measure('conf unchanged', lambda: bb.update_local_conf(cfg, ctx))
+
+    def env(self):
+        build_dir = self.workdir.joinpath('env')
+        build_dir.mkdir()
+        bb = self.mb.bitbaker(self.poky_dir, build_dir.joinpath('rootfs'), build_dir)
+
+        def query(names=None):
+            env = bb.query_target_env('u-boot-socfpga', names)
+            missing = [name for name in self.wanted if env.get(name) != self.wanted[name]]
+            if missing:
+                raise SystemExit(f'env parser missed {", ".join(missing)}')
+
+        self.measure(f'env parse {self.args.env_mb:g}MB', query)
+        self.measure(f'env query {len(self.wanted)} vars', lambda: query(list(self.wanted)))
+
+    def stage(self):
+        src_dir = self.workdir.joinpath('stage-src')
+        dst_dir = self.workdir.joinpath('stage-dst')
+        src_dir.mkdir()
+        block = os.urandom(1024)
+        for n in range(self.args.files):
+            src_dir.joinpath(f'artifact-{n}.bin').write_bytes(block * self.args.file_kb)
+
+        def clean():
+            shutil.rmtree(dst_dir, ignore_errors=True)
+            dst_dir.mkdir()
+
+        def stage_all():
+            for src in src_dir.iterdir():
+                self.mb.STAGER.stage(src, dst_dir)
+
+        self.measure(f'stage {self.args.files} files', stage_all, clean)
+        self.measure(f'stage {self.args.files} unchanged', stage_all)
+
+    def sign(self):
+        sign_dir = self.workdir.joinpath('sign')
+        build_vab = sign_dir.joinpath('build_vab')
+        build_vab.mkdir(parents=True)
+        qky = sign_dir.joinpath('key.qky')
+        pem = sign_dir.joinpath('key.pem')
+        qky.write_text('qky\n')
+        pem.write_text('pem\n')
+        fnames = []
+        for n in range(self.args.binaries):
+            fname = f'u-boot-part-{n}.bin'
+            build_vab.joinpath(fname).write_bytes(os.urandom(1024) * 64)
+            fnames.append(fname)
+        tools = {'fcs_prepare': str(self.bin_dir.joinpath('fcs_prepare')),
+                 'quartus_sign': str(self.bin_dir.joinpath('quartus_sign')),
+                 'qky': str(qky), 'pem': str(pem), 'build_vab': str(build_vab)}
+        cache_dir = sign_dir.joinpath('cache')
+
+        for jobs in sorted({1, self.args.jobs}):
+            signer = self.mb.vab_signer(**tools)
+            self.measure(f'sign {len(fnames)} jobs={jobs}',
+                         lambda: signer.sign_all(fnames, jobs=jobs))
+        signer = self.mb.vab_signer(**tools, cache_dir=cache_dir)
+        signer.sign_all(fnames, jobs=self.args.jobs)
+        self.measure(f'sign {len(fnames)} cached', lambda: signer.sign_all(fnames, jobs=self.args.jobs))
+
+    def premirror(self):
+        upstream_dir = self.workdir.joinpath('premirror-upstream')
+        dl_dir = self.workdir.joinpath('premirror-downloads')
+        store_dir = self.workdir.joinpath('premirror-store')
+        upstream_dir.mkdir()
+        block = os.urandom(1024)
+        for n in range(self.args.tarballs):
+            upstream_dir.joinpath(f'source-{n}.tar.gz').write_bytes(block * self.args.file_kb)
+        upstream = self.mb.premirror(f'file://{upstream_dir}')
+        if upstream.local_values().get('PREMIRRORS', '').split()[1] != f'file://{upstream_dir}/':
+            raise SystemExit(f'premirror does not point to {upstream_dir}')
+
+        def fetch():
+            # what a fetch against the upstream mirror leaves in DL_DIR
+            shutil.rmtree(dl_dir, ignore_errors=True)
+            dl_dir.joinpath('git2', 'layer.git').mkdir(parents=True)
+            for src in upstream_dir.iterdir():
+                shutil.copy(src, dl_dir)
+                dl_dir.joinpath(f'{src.name}.done').touch()
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+        store = None
+
+        def update():
+            nonlocal store
+            store = self.mb.premirror(str(store_dir), refresh=True)
+            if store.local_values().get('BB_GENERATE_MIRROR_TARBALLS') != '1':
+                raise SystemExit('refreshed premirror does not generate mirror tarballs')
+            store.update(dl_dir)
+
+        self.measure(f'premirror {self.args.tarballs} tarballs', update, fetch)
+        self.measure(f'premirror {self.args.tarballs} unchanged', lambda: store.update(dl_dir))
+        stored = sorted(p.name for p in store_dir.iterdir())
+        if stored != sorted(p.name for p in upstream_dir.iterdir()):
+            raise SystemExit(f'premirror store has {len(stored)} of {self.args.tarballs} tarballs')
+
+    def report(self):
+        LOG.info(f'{"benchmark":<32} {"repeat":>6} {"min":>9} {"mean":>9} {"peak":>10}')
+        for r in self.results:
+            LOG.info(f'{r["name"]:<32} {r["repeat"]:6} {r["min"]:8.3f}s {r["mean"]:8.3f}s '
+                     f'{r["peak_kb"]:8}kB')
+
+
+BENCHMARKS = ['sync', 'conf', 'env', 'stage', 'sign', 'premirror']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f'benchmarks to run, any of {", ".join(BENCHMARKS)} (default all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to run each benchmark')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='workers for the concurrent steps (sync, sign)')
+    parser.add_argument('--repos', type=int, default=8,
+                        help='number of repos to sync')
+    parser.add_argument('--git-delay', type=float, default=0.05,
+                        help='seconds every git command sleeps')
+    parser.add_argument('--bitbake-delay', type=float, default=0.0,
+                        help='seconds every bitbake command sleeps')
+    parser.add_argument('--env-mb', type=float, default=20,
+                        help='size of the bitbake -e dump in MB')
+    parser.add_argument('--conf-lines', type=int, default=2000,
+                        help='number of settings in local.conf')
+    parser.add_argument('--files', type=int, default=100,
+                        help='number of artifacts to stage')
+    parser.add_argument('--file-kb', type=int, default=256,
+                        help='size of each artifact and premirror tarball in kB')
+    parser.add_argument('--tarballs', type=int, default=50,
+                        help='number of tarballs to add to the premirror')
+    parser.add_argument('--binaries', type=int, default=8,
+                        help='number of binaries to sign')
+    parser.add_argument('--sign-delay', type=float, default=0.2,
+                        help='seconds quartus_sign sleeps (fcs_prepare sleeps half)')
+    parser.add_argument('--workdir', type=Path,
+                        help='scratch directory to use and keep (default a removed temp dir)')
+    parser.add_argument('--json', type=Path,
+                        help='also write the results to this file')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    fmt = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s')
+    stdout_h = logging.StreamHandler(sys.stdout)
+    stdout_h.setFormatter(fmt)
+    LOG.setLevel(logging.INFO)
+    LOG.addHandler(stdout_h)
+    LOG.propagate = False
+
+    mb = load_meta_bake()
+    # meta-bake logs to the root logger, keep its per-step output out of the way
+    mb.LOG.setLevel(logging.ERROR)
+
+    if args.workdir:
+        args.workdir.mkdir(parents=True, exist_ok=True)
+        workdir = Path(tempfile.mkdtemp(dir=args.workdir))
+    else:
+        workdir = Path(tempfile.mkdtemp(prefix='meta-bake-bench-'))
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        b = bench(mb, args, workdir)
+        for name in args.benchmarks or BENCHMARKS:
+            LOG.info(f'running {name}')
+            getattr(b, name)()
+        b.report()
+        if args.json:
+            with open(Path(cwd, args.json), 'w') as fp:
+                json.dump(b.results, fp, indent=2)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,32 +24,79 @@
 # CONTRACT,  STRICT LIABILITY,  OR TORT  (INCLUDING NEGLIGENCE  OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,  EVEN I
 import argparse
+import asyncio
+import atexit
+import contextlib
+import copy
+import fcntl
+import filecmp
+import hashlib
+import io
+import json
 import logging
+import logging.handlers
 import re
 import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
 import yaml
 import os
+import queue
+import tarfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
 
 LOG = logging.getLogger()
 
+# local changes are the SRCREVs update_meta writes and the repo patch, both
+# are made again after every update, so they are thrown away here
 GIT_UPDATE = '''
-git checkout master
-git branch -D {branch} || true
-git fetch origin
-git pull
-git checkout {branch}
+set -e
+git fetch origin +refs/heads/{branch}:refs/remotes/origin/{branch}
+git reset -q --hard
+git checkout -B {branch} origin/{branch}
 '''.strip()
 
 
 GIT_CLONE = '''
+set -e
 git clone -b {branch} {url} {srcdir}
 '''.strip()
 
+GIT_UPDATE_FROM = '''
+set -e
+git fetch {fetch_opts} {source} +refs/heads/{branch}:refs/remotes/origin/{branch}
+git reset -q --hard
+git checkout -B {branch} origin/{branch}
+'''.strip()
+
+
+GIT_CLONE_FROM = '''
+set -e
+git clone {clone_opts} -b {branch} {source} {srcdir}
+git -C {srcdir} remote set-url origin {url}
+'''.strip()
+
+
+GIT_MIRROR_CLONE = '''
+set -e
+git clone --mirror {url} {mirror}
+git -C {mirror} config gc.auto 0
+git -C {mirror} config uploadpack.allowFilter true
+'''.strip()
+
+
+GIT_MIRROR_FETCH = '''
+set -e
+git -C {mirror} remote update --prune
+'''.strip()
+
 GIT_LSREMOTE = '''
-git ls-remote {url} {branch}
+git ls-remote {url} {refs}
 '''.strip()
 
 YOCTO_BUILD = '''
@@ -57,6 +104,12 @@ source {rootfs_dir}/conf/local.conf {build_dir}
 bitbake virtual/kernel -c cleanall
 '''
 
+UBOOT_ENV_VARS = ['S', 'B']
+
+IMAGE_ENV_VARS = ['DEPLOY_DIR_IMAGE', 'IMAGE_BASENAME']
+
+UBOOT_VAB_DEFCONFIG = 'socfpga_agilex_n6000_vab_defconfig'
+
 YOCTO_CLEANUP = '''
 rm -rf {rootfs_dir}/tmp
 rm -rf {rootfs_dir}/conf
@@ -64,6 +117,800 @@ rm -rf {images_dir}/*
 '''
 
 
+def sha256sum(path, blocksize=1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class artifact_stager:
+    '''Put artifacts in place by reflink, hardlink or copy, skipping identical ones.'''
+    FICLONE = 0x40049409
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = {'same': 0, 'reflink': 0, 'hardlink': 0, 'copy': 0}
+        self.bytes = dict.fromkeys(self.count, 0)
+
+    def reflink(self, src: Path, dst: Path) -> bool:
+        try:
+            with src.open('rb') as src_fp, dst.open('wb') as dst_fp:
+                fcntl.ioctl(dst_fp.fileno(), self.FICLONE, src_fp.fileno())
+        except OSError:
+            dst.unlink(missing_ok=True)
+            return False
+        shutil.copystat(src, dst)
+        return True
+
+    def stage(self, src, dst, link: bool = False) -> Path:
+        src = Path(src)
+        dst = Path(dst)
+        if dst.is_dir():
+            dst = dst.joinpath(src.name)
+        size = src.stat().st_size
+        if dst.exists() and (os.path.samefile(src, dst) or filecmp.cmp(src, dst, shallow=True)):
+            method = 'same'
+        else:
+            dst.unlink(missing_ok=True)
+            if self.reflink(src, dst):
+                method = 'reflink'
+            else:
+                try:
+                    if not link:
+                        raise OSError('hardlink not allowed')
+                    os.link(src, dst)
+                    method = 'hardlink'
+                except OSError:
+                    shutil.copy2(src, dst)
+                    method = 'copy'
+        with self.lock:
+            self.count[method] += 1
+            self.bytes[method] += size
+        LOG.debug(f'staged {src} -> {dst} ({method})')
+        return dst
+
+    def report(self):
+        staged = sum(self.count.values())
+        if not staged:
+            return
+        saved = self.bytes['same'] + self.bytes['reflink'] + self.bytes['hardlink']
+        LOG.info(f'staged {staged} artifacts: {self.bytes["copy"] >> 20} MiB copied, '
+                 f'{saved >> 20} MiB saved')
+        for method in self.count:
+            LOG.info(f'  {method:<10} {self.count[method]:5} files {self.bytes[method] >> 20:8} MiB')
+
+
+STAGER = artifact_stager()
+
+
+def parse_size(size) -> int:
+    '''Bytes in a size given as a number or with a K, M, G or T suffix.'''
+    size = str(size).strip().upper().rstrip('B')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class hashing_file:
+    '''File object wrapper that computes the sha256 of what passes through it.'''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        return data
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+    def close(self):
+        self.fp.close()
+
+
+class image_packager:
+    '''Stream build outputs into a compressed tar archive with a manifest and SHA256SUMS.'''
+    COMPRESSORS = {'zstd': ('.tar.zst', ['zstd', '-T0', '-q', '-c']),
+                   'xz': ('.tar.xz', ['xz', '-T0', '-c'])}
+
+    def __init__(self, archive_base: Path, compression: str = 'zstd', level: int = None,
+                 info: dict = None):
+        suffix, self.cmd = self.COMPRESSORS[compression]
+        self.cmd = list(self.cmd)
+        if level is not None:
+            self.cmd.append(f'-{level}')
+        self.path = Path(archive_base).absolute().with_name(Path(archive_base).name + suffix)
+        self.tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+        self.info = info or {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.files = {}
+        self.added = set()
+        self.error = None
+        self.tar = None
+        self.out = None
+        self.proc = None
+        self.threads = []
+
+    def start(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.out = hashing_file(self.tmp_path.open('wb'))
+        if shutil.which(self.cmd[0]):
+            self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.tar = tarfile.open(fileobj=self.proc.stdin, mode='w|', dereference=True)
+            self.threads.append(threading.Thread(target=self.copy_out, daemon=True))
+        else:
+            LOG.warning(f'{self.cmd[0]} not found, compressing {self.path.name} with lzma')
+            self.tar = tarfile.open(fileobj=self.out, mode='w|xz', dereference=True)
+        self.threads.append(threading.Thread(target=self.write_members, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        LOG.info(f'packaging into {self.path}')
+
+    def copy_out(self):
+        for chunk in iter(lambda: self.proc.stdout.read(1 << 20), b''):
+            self.out.write(chunk)
+
+    def write_members(self):
+        for path, arcname in iter(self.queue.get, None):
+            if self.error is not None:
+                continue
+            try:
+                tarinfo = self.tar.gettarinfo(path, arcname)
+                with open(path, 'rb') as fp:
+                    reader = hashing_file(fp)
+                    self.tar.addfile(tarinfo, reader)
+                self.files[arcname] = {'sha256': reader.digest.hexdigest(), 'size': reader.size}
+            except (OSError, tarfile.TarError) as err:
+                self.error = err
+
+    def add(self, path, arcname: str = None):
+        arcname = arcname or Path(path).name
+        with self.lock:
+            if arcname in self.added:
+                return
+            if self.tar is None:
+                self.start()
+            self.added.add(arcname)
+            self.queue.put((str(path), arcname))
+
+    def add_bytes(self, arcname: str, data: bytes):
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = len(data)
+        tarinfo.mtime = int(time.time())
+        self.tar.addfile(tarinfo, io.BytesIO(data))
+
+    def close(self) -> Path:
+        with self.lock:
+            if self.tar is None:
+                self.start()
+        self.queue.put(None)
+        self.threads[-1].join()
+        if self.error is not None:
+            self.abort()
+            raise SystemExit(f'failed to package {self.path.name}: {self.error}')
+        manifest = {'info': self.info, 'files': self.files,
+                    'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.add_bytes('manifest.json', json.dumps(manifest, indent=2).encode())
+        sums = ''.join(f'{f["sha256"]}  {name}\n' for name, f in sorted(self.files.items()))
+        self.add_bytes('SHA256SUMS', sums.encode())
+        self.tar.close()
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.threads[0].join()
+            if self.proc.wait():
+                self.abort()
+                raise SystemExit(f'{self.cmd[0]} failed packaging {self.path.name}')
+        self.out.close()
+        os.replace(self.tmp_path, self.path)
+        self.path.with_name(self.path.name + '.sha256').write_text(
+            f'{self.out.digest.hexdigest()}  {self.path.name}\n')
+        LOG.info(f'packaged {len(self.files)} files into {self.path} '
+                 f'({self.out.size / (1 << 20):.1f} MiB)')
+        self.tar = None
+        return self.path
+
+    def abort(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+        if self.out is not None:
+            self.out.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+class artifact_cache:
+    '''Content-addressed store of the final images of a build, shareable between hosts.'''
+
+    def __init__(self, path: Path, max_size: int = None):
+        self.path = Path(path).expanduser().absolute()
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(data) -> str:
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.path.joinpath(key[:2], key)
+
+    def restore(self, key: str, dst_dir: Path, names: list) -> bool:
+        entry = self.entry(key)
+        manifest = entry.joinpath('manifest.json')
+        try:
+            with manifest.open('r') as fp:
+                files = json.load(fp)['files']
+        except (OSError, ValueError, KeyError):
+            return False
+        if sorted(files) != sorted(names) or not all(entry.joinpath(n).exists() for n in names):
+            return False
+        dst_dir.mkdir(parents=True, exist_ok=True)
+        for name in names:
+            STAGER.stage(entry.joinpath(name), dst_dir.joinpath(name), link=True)
+        os.utime(manifest)
+        LOG.info(f'restored {", ".join(names)} from {entry}')
+        return True
+
+    def store(self, key: str, src_dir: Path, names: list, info: dict = None):
+        entry = self.entry(key)
+        if entry.exists():
+            return
+        tmp_dir = entry.parent.joinpath(f'.{key}.{os.uname().nodename}.{os.getpid()}')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        files = {}
+        for name in names:
+            STAGER.stage(src_dir.joinpath(name), tmp_dir.joinpath(name))
+            files[name] = sha256sum(tmp_dir.joinpath(name))
+        with tmp_dir.joinpath('manifest.json').open('w') as fp:
+            json.dump({'files': files, 'info': info or {},
+                       'created': time.strftime('%Y-%m-%d %H:%M:%S')}, fp, indent=2)
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # another build stored the same images first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        LOG.info(f'stored {", ".join(names)} in {entry}')
+        self.evict(keep=entry)
+
+    def evict(self, keep: Path = None):
+        if not self.max_size:
+            return
+        with open(self.path.joinpath('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for manifest in self.path.glob('??/*/manifest.json'):
+                try:
+                    used = manifest.stat().st_mtime
+                    size = sum(f.stat().st_size for f in manifest.parent.iterdir())
+                except OSError:
+                    continue
+                entries.append((used, size, manifest.parent))
+            total = sum(size for _, size, _ in entries)
+            for used, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if entry == keep:
+                    continue
+                LOG.info(f'evicting {entry.name} from the artifact cache')
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+
+class resource_model:
+    '''Cores, memory and disk of the host (or its cgroup) and the parallelism they can take.'''
+
+    MEM_PER_JOB = 2 << 30
+    ROTATIONAL_THREADS = 8
+    # microseconds stalled per second above which bitbake starts no new tasks
+    PRESSURE_MAX = {'cpu': 15000, 'io': 15000, 'memory': 1000}
+
+    def __init__(self, build_dir: Path, mem_per_job=None, pressure_max: dict = None):
+        self.mem_per_job = parse_size(mem_per_job) if mem_per_job else self.MEM_PER_JOB
+        self.pressure_max = {**self.PRESSURE_MAX, **(pressure_max or {})}
+        self.cores = self.read_cores()
+        self.memory = self.read_memory()
+        self.rotational = self.is_rotational(build_dir)
+        self.psi = Path('/proc/pressure/memory').exists()
+
+    @staticmethod
+    def read_cores() -> int:
+        cores = len(os.sched_getaffinity(0))
+        try:
+            quota, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+            if quota != 'max':
+                cores = min(cores, max(1, -(-int(quota) // int(period))))
+        except (OSError, ValueError):
+            pass
+        return cores
+
+    @staticmethod
+    def read_memory() -> int:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        for limit in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+            try:
+                memory = min(memory, int(Path(limit).read_text()))
+            except (OSError, ValueError):
+                continue
+        return memory
+
+    @staticmethod
+    def is_rotational(path: Path) -> bool:
+        dev = os.stat(path).st_dev
+        block = Path(f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}')
+        # partitions keep their queue/ in the parent device
+        for queue in [block.joinpath('queue'), block.joinpath('..', 'queue')]:
+            try:
+                return queue.joinpath('rotational').read_text().strip() == '1'
+            except OSError:
+                continue
+        return False
+
+    def tune(self, builds: int = 1) -> dict:
+        '''Thread and job counts for each of builds running at once.'''
+        cores = max(1, self.cores // builds)
+        jobs = max(1, min(cores, self.memory // builds // self.mem_per_job))
+        if jobs < cores:
+            # memory bound, keep threads x make jobs within what fits
+            threads = max(1, int(jobs ** 0.5))
+            make_jobs = max(1, jobs // threads)
+        else:
+            # bitbake's own defaults
+            threads = make_jobs = jobs
+        if self.rotational:
+            threads = min(threads, self.ROTATIONAL_THREADS)
+        return {'jobs': jobs, 'threads': threads, 'make_jobs': make_jobs}
+
+    def local_values(self, builds: int = 1) -> dict:
+        tuned = self.tune(builds)
+        values = {'BB_NUMBER_THREADS': str(tuned['threads']),
+                  'PARALLEL_MAKE': f'-j {tuned["make_jobs"]}'}
+        if self.psi:
+            for name, limit in self.pressure_max.items():
+                values[f'BB_PRESSURE_MAX_{name.upper()}'] = str(limit)
+        return values
+
+    def report(self):
+        LOG.info(f'host has {self.cores} cores, {self.memory / (1 << 30):.1f}G of memory and '
+                 f'a {"rotational" if self.rotational else "solid state"} build disk')
+
+
+class pressure_monitor:
+    '''Warn while the host is stalling on memory (/proc/pressure/memory) and report the peak.'''
+
+    def __init__(self, interval: float = 5, warn: float = 10.0):
+        self.interval = interval
+        self.warn = warn
+        self.peak = 0.0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def read() -> float:
+        for line in Path('/proc/pressure/memory').read_text().splitlines():
+            kind, *fields = line.split()
+            if kind == 'full':
+                return float(dict(f.split('=') for f in fields)['avg10'])
+        return 0.0
+
+    def watch(self):
+        stalled = False
+        while not self.stop_event.wait(self.interval):
+            try:
+                avg10 = self.read()
+            except (OSError, ValueError, KeyError):
+                return
+            self.peak = max(self.peak, avg10)
+            if avg10 >= self.warn and not stalled:
+                LOG.warning(f'memory pressure: all tasks stalled {avg10:.1f}% of the last 10s')
+            stalled = avg10 >= self.warn
+
+    def start(self):
+        if not Path('/proc/pressure/memory').exists():
+            LOG.debug('no /proc/pressure, not watching memory pressure')
+            return
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        LOG.info(f'peak memory pressure: {self.peak:.1f}% full stall over 10s')
+
+
+class tracer:
+    '''Record phases and subprocesses of a run as Chrome trace events.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def add(self, name: str, cat: str, start: float, end: float, args: dict = None,
+            pid=None, tid=None):
+        event = {'name': name, 'cat': cat, 'ph': 'X',
+                 'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                 'pid': pid if pid is not None else os.getpid(),
+                 'tid': tid if tid is not None else threading.get_ident(),
+                 'args': args or {}}
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str = 'phase', **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time.time(), args)
+
+    @staticmethod
+    def exit_code(status: int) -> int:
+        '''The returncode subprocess would report for a wait status.'''
+        return -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    @staticmethod
+    def usage(rusage) -> dict:
+        return {'cpu': round(rusage.ru_utime + rusage.ru_stime, 3), 'maxrss_kb': rusage.ru_maxrss}
+
+    def wait(self, proc: subprocess.Popen, cmd, cwd, start: float) -> int:
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = self.exit_code(status)
+        end = time.time()
+        name = cmd if isinstance(cmd, str) else ' '.join(str(c) for c in cmd)
+        if name.startswith('/bin/bash -c '):
+            name = name[len('/bin/bash -c '):]
+        self.add(name.splitlines()[-1][:80] if name.strip() else name, 'subprocess', start, end,
+                 {'cmd': name, 'cwd': str(cwd or os.getcwd()),
+                  'exit_code': proc.returncode,
+                  'wall': round(end - start, 3),
+                  **self.usage(rusage)})
+        return proc.returncode
+
+    def call(self, cmd, **kwargs) -> int:
+        start = time.time()
+        proc = subprocess.Popen(cmd, **kwargs)
+        return self.wait(proc, cmd, kwargs.get('cwd'), start)
+
+    def check_call(self, cmd, **kwargs):
+        returncode = self.call(cmd, **kwargs)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return 0
+
+    def check_output(self, cmd, **kwargs) -> bytes:
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs)
+        output = proc.stdout.read()
+        proc.stdout.close()
+        returncode = self.wait(proc, cmd, kwargs.get('cwd'), start)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, output)
+        return output
+
+    def add_buildstats(self, tmp_dir: Path, since: float, pid: str):
+        '''Fold bitbake buildstats written after since into the trace.'''
+        buildstats = Path(tmp_dir, 'buildstats')
+        if not buildstats.is_dir():
+            return
+        for run_dir in buildstats.iterdir():
+            if not run_dir.is_dir() or run_dir.stat().st_mtime < since:
+                continue
+            for task_file in run_dir.glob('*/do_*'):
+                stats = {}
+                for line in task_file.read_text(errors='replace').splitlines():
+                    key, _, value = line.partition(':')
+                    stats[key.strip()] = value.strip()
+                try:
+                    start = float(stats['Started'])
+                    end = float(stats['Ended'])
+                except (KeyError, ValueError):
+                    continue
+                self.add(task_file.name, 'bitbake', start, end,
+                         {'recipe': task_file.parent.name, 'status': stats.get('Status', '')},
+                         pid=pid, tid=task_file.parent.name)
+
+    def summary(self):
+        phases = {}
+        for event in self.events:
+            if event['cat'] in ('phase', 'sync', 'sign'):
+                count, total = phases.get(event['name'], (0, 0))
+                phases[event['name']] = (count + 1, total + event['dur'] / 1e6)
+        LOG.info(f'{"phase":<40} {"count":>5} {"seconds":>10}')
+        for name, (count, total) in phases.items():
+            LOG.info(f'{name:<40} {count:5} {total:10.1f}')
+        recipes = {}
+        for event in self.events:
+            if event['cat'] == 'bitbake':
+                recipe = event['args']['recipe']
+                recipes[recipe] = recipes.get(recipe, 0) + event['dur'] / 1e6
+        if recipes:
+            LOG.info(f'{"slowest recipes":<40} {"":>5} {"seconds":>10}')
+            for recipe, total in sorted(recipes.items(), key=lambda r: -r[1])[:10]:
+                LOG.info(f'{recipe:<40} {"":>5} {total:10.1f}')
+
+    def save(self, path: Path):
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e['ts'])
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+        LOG.info(f'wrote trace of {len(events)} events to {path}')
+
+
+TRACE = tracer()
+
+
+class step_runner:
+    '''Run long commands with their output streamed to per-step log files.'''
+    PROGRESS_RE = re.compile(r'Running (?:setscene )?task (?P<done>\d+) of (?P<total>\d+)')
+    LINE_LIMIT = 1 << 20
+
+    def __init__(self):
+        self.log_dir = Path('logs')
+        self.timeout = None
+        self.progress_interval = 60
+        self.max_bytes = 64 << 20
+        self.backups = 3
+        self.tail = 20
+
+    def configure(self, log_dir: Path, timeout: float = None, progress_interval: float = 60):
+        self.log_dir = log_dir
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+
+    def step_log(self, name: str) -> logging.Logger:
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        log = logging.getLogger(f'meta-bake.step.{name}')
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        if not log.handlers:
+            handler = logging.handlers.RotatingFileHandler(self.log_dir.joinpath(f'{name}.log'),
+                                                           maxBytes=self.max_bytes,
+                                                           backupCount=self.backups)
+            handler.setFormatter(logging.Formatter('[%(asctime)s][%(stream)s] %(message)s'))
+            log.addHandler(handler)
+        return log
+
+    async def pump(self, stream, log: logging.Logger, label: str, tail: deque, progress: dict):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                log.info('[line longer than %d bytes dropped]', self.LINE_LIMIT,
+                         extra={'stream': label})
+                continue
+            if not line:
+                break
+            line = line.decode(errors='replace').rstrip()
+            log.info(line, extra={'stream': label})
+            tail.append(line)
+            m = self.PROGRESS_RE.search(line)
+            if m:
+                progress['done'], progress['total'] = int(m.group('done')), int(m.group('total'))
+
+    async def report(self, name: str, start: float, progress: dict):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            elapsed = time.monotonic() - start
+            if progress.get('done'):
+                done, total = progress['done'], progress['total']
+                eta = elapsed / done * (total - done)
+                LOG.info(f'{name}: task {done} of {total} ({100 * done // total}%), '
+                         f'{elapsed:.0f}s elapsed, about {eta:.0f}s left')
+            else:
+                LOG.info(f'{name}: running for {elapsed:.0f}s')
+
+    async def reader(self, pipe) -> asyncio.StreamReader:
+        stream = asyncio.StreamReader(limit=self.LINE_LIMIT)
+        await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stream), pipe)
+        return stream
+
+    async def run_async(self, name: str, cmd: list, timeout: float = None, check: bool = True,
+                        **kwargs):
+        '''Run cmd to completion, returns its returncode and rusage.'''
+        log = self.step_log(name)
+        log.info(' '.join(str(c) for c in cmd), extra={'stream': 'cmd'})
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                start_new_session=True, **kwargs)
+        waiter = asyncio.get_running_loop().run_in_executor(None, os.wait4, proc.pid, 0)
+        tail = deque(maxlen=self.tail)
+        progress = {}
+        reporter = asyncio.ensure_future(self.report(name, start, progress))
+        pumps = asyncio.gather(self.pump(await self.reader(proc.stdout), log, 'stdout', tail, progress),
+                               self.pump(await self.reader(proc.stderr), log, 'stderr', tail, progress),
+                               asyncio.shield(waiter))
+        try:
+            await asyncio.wait_for(pumps, timeout)
+        except asyncio.TimeoutError:
+            LOG.error(f'{name} did not finish in {timeout}s, stopping it')
+            os.killpg(proc.pid, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), 30)
+            except asyncio.TimeoutError:
+                os.killpg(proc.pid, signal.SIGKILL)
+                await waiter
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        finally:
+            reporter.cancel()
+            # the pid is reaped already, keep Popen from waiting for it again
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                proc.returncode = TRACE.exit_code(waiter.result()[1])
+        _, _, rusage = waiter.result()
+        if proc.returncode and check:
+            LOG.error(f'{name} failed with exit code {proc.returncode}, last output:')
+            for line in tail:
+                LOG.error(f'  {line}')
+        return proc.returncode, rusage
+
+    def run(self, name: str, cmd: list, check: bool = True, timeout: float = None, **kwargs) -> int:
+        name = re.sub(r'[^\w\-\.]', '_', name)
+        timeout = timeout or self.timeout
+        LOG.info(f'running {name}, output in {self.log_dir.joinpath(name + ".log")}')
+        start = time.time()
+        returncode = None
+        usage = {}
+        try:
+            returncode, rusage = asyncio.run(self.run_async(name, cmd, timeout, check, **kwargs))
+            usage = TRACE.usage(rusage)
+        finally:
+            TRACE.add(name, 'step', start, time.time(),
+                      {'cmd': ' '.join(str(c) for c in cmd), 'cwd': str(kwargs.get('cwd', os.getcwd())),
+                       'exit_code': returncode, **usage})
+        if check and returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return returncode
+
+
+RUNNER = step_runner()
+
+
+class pipeline:
+    '''Run named steps in dependency order, independent steps concurrently.
+
+    Finished steps are checkpointed so a resumed run skips those whose inputs did not change.
+    '''
+
+    def __init__(self, checkpoint_file: Path, resume: bool = False, from_step: str = None):
+        self.checkpoint_file = checkpoint_file
+        self.resume = resume or from_step is not None
+        self.from_step = from_step
+        self.steps = {}
+        self.limits = {}
+        self.results = {}
+        self.digests = {}
+        self.ran = set()
+        self.timings = {}
+        self.lock = threading.Lock()
+        self.checkpoint = {}
+        if checkpoint_file.exists():
+            with checkpoint_file.open('r') as fp:
+                self.checkpoint = json.load(fp)
+
+    def add(self, name: str, func, deps=(), inputs=None, outputs=(), group: str = None,
+            always: bool = False):
+        for dep in deps:
+            if dep not in self.steps:
+                raise ValueError(f'{name} depends on unknown step {dep}')
+        self.steps[name] = {'func': func, 'deps': list(deps), 'inputs': inputs,
+                            'outputs': outputs, 'group': group, 'always': always}
+
+    def limit(self, group: str, jobs: int):
+        self.limits[group] = threading.Semaphore(max(1, jobs))
+
+    def descendants(self, names: set) -> set:
+        found = set(names)
+        for name, step in self.steps.items():
+            # steps are added after their dependencies so one pass is enough
+            if any(dep in found for dep in step['deps']):
+                found.add(name)
+        return found
+
+    def forced(self) -> set:
+        if self.from_step is None:
+            return set()
+        names = {n for n in self.steps if n == self.from_step or n.split(':')[0] == self.from_step}
+        if not names:
+            raise SystemExit(f'unknown step {self.from_step}, steps are: {", ".join(self.steps)}')
+        return self.descendants(names)
+
+    def digest(self, name: str) -> str:
+        step = self.steps[name]
+        inputs = step['inputs']() if step['inputs'] else None
+        data = [inputs, [self.digests[dep] for dep in step['deps']]]
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def save(self):
+        tmp_file = self.checkpoint_file.with_suffix('.tmp')
+        with tmp_file.open('w') as fp:
+            json.dump(self.checkpoint, fp, indent=2, default=str)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def execute(self, name: str, force: bool):
+        step = self.steps[name]
+        digest = self.digest(name)
+        if step['always']:
+            start = time.monotonic()
+            with TRACE.span(name, 'phase'):
+                result = step['func']()
+            self.timings[name] = time.monotonic() - start
+            return digest, result, False
+        saved = self.checkpoint.get(name, {})
+        if (self.resume and not force and saved.get('inputs') == digest
+                and not any(dep in self.ran for dep in step['deps'])
+                and all(Path(output).exists() for output in step['outputs'])):
+            LOG.info(f'skipping {name}, unchanged since {saved.get("finished", "the last run")}')
+            return digest, saved.get('result'), False
+        with self.lock:
+            self.checkpoint.pop(name, None)
+            self.save()
+        group = self.limits.get(step['group'])
+        with group if group is not None else contextlib.nullcontext():
+            LOG.info(f'running step {name}')
+            start = time.monotonic()
+            with TRACE.span(name, 'phase'):
+                result = step['func']()
+            self.timings[name] = time.monotonic() - start
+        with self.lock:
+            self.checkpoint[name] = {'inputs': digest, 'result': result,
+                                     'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+            self.save()
+        return digest, result, True
+
+    def run(self) -> dict:
+        forced = self.forced()
+        pending = list(self.steps)
+        failures = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=len(self.steps) or 1) as pool:
+            while pending or running:
+                ready = [name for name in pending
+                         if all(dep in self.digests for dep in self.steps[name]['deps'])]
+                # steps after a failed one never become ready, the rest carry on
+                for name in ready:
+                    pending.remove(name)
+                    running[pool.submit(self.execute, name, name in forced)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        digest, result, ran = future.result()
+                    except (Exception, SystemExit) as err:
+                        failures[name] = err
+                        continue
+                    self.digests[name] = digest
+                    self.results[name] = result
+                    if ran:
+                        self.ran.add(name)
+
+        for name in self.steps:
+            if name in failures:
+                LOG.error(f'  {name:<40}   failed: {failures[name]}')
+            elif name in self.timings:
+                LOG.info(f'  {name:<40} {self.timings[name]:8.1f}s')
+            elif name in self.digests:
+                LOG.info(f'  {name:<40}  skipped')
+            else:
+                LOG.info(f'  {name:<40}  not run')
+        if failures:
+            raise SystemExit(f'failed steps: {", ".join(failures)} '
+                             '(fix and rerun with --resume to continue from there)')
+        return self.results
+
+
 class dot_version:
     VERSION_RE = re.compile('(?P<version>\d+(?:\.\d+)*)')
 
@@ -80,6 +927,40 @@ class dot_version:
             yield cls(v)
 
 
+class recipe_index:
+    '''Map recipe names to the versions of them found in a recipe directory.'''
+    RECIPE_RE = re.compile(r'^(?P<name>.+?)[_-]v?(?P<version>\d+(?:\.\d+)*)[^/]*\.bb$')
+
+    @classmethod
+    def get(cls, directory: Path) -> dict:
+        if not directory.is_dir():
+            return {}
+        index = {}
+        for bb_file in directory.iterdir():
+            m = cls.RECIPE_RE.match(bb_file.name)
+            if m:
+                index.setdefault(m.group('name'), []).append((dot_version(m.group('version')), bb_file))
+        for versions in index.values():
+            versions.sort(key=lambda v: (v[0].num_version, v[1].name))
+        return index
+
+    @classmethod
+    def find(cls, directory: Path, name: str, version_str: str) -> Path:
+        '''Find the recipe of name that best matches version_str.'''
+        versions = cls.get(directory).get(name)
+        if not versions:
+            # building with the old SRCREV would silently build the wrong source
+            raise SystemExit(f'no recipe for ingredient {name} {version_str} in {directory}')
+        wanted = dot_version(version_str).num_version
+        matches = [(len(v.num_version), v.num_version, bb_file) for v, bb_file in versions
+                   if wanted[:len(v.num_version)] == v.num_version]
+        if matches:
+            return max(matches)[2]
+        last = versions[-1][1]
+        LOG.warn(f'cannot find recipe named for version {version_str}, using {last.stem}')
+        return last
+
+
 class git_repo:
     URL_RE = re.compile('(?P<scheme>[\w\+]+)://(?P<fqdn>[\w\.-]+)/(?P<path>.*?)/(?P<name>[\w-]+)(\.git)?')
 
@@ -93,102 +974,658 @@ class git_repo:
         self.branch = kwargs.get('branch', 'master')
         self.topdir = kwargs.get('topdir', 'build')
         self.srcdir = Path(self.topdir, self.name)
+        self.depth = kwargs.get('depth')
+        self.filter = kwargs.get('filter')
+        self.mirror = None
+        self.mirror_ttl = kwargs.get('mirror_ttl', 3600)
+        mirror_root = kwargs.get('mirror')
+        if mirror_root:
+            url_hash = hashlib.sha1(self.url.encode()).hexdigest()[:12]
+            self.mirror = Path(mirror_root).expanduser().absolute().joinpath(
+                f'{self.name}-{url_hash}.git')
+
+    @property
+    def shallow(self):
+        return self.depth is not None or self.filter is not None
+
+    def fetch_opts(self):
+        opts = []
+        if self.depth is not None:
+            opts.append(f'--depth {self.depth}')
+        if self.filter is not None:
+            opts.append(f'--filter={self.filter}')
+        return ' '.join(opts)
+
+    def sync_mirror(self):
+        '''Create or refresh the bare mirror of this repo, shared by every build dir on the host.'''
+        self.mirror.parent.mkdir(parents=True, exist_ok=True)
+        stamp = self.mirror.joinpath('meta-bake-fetched')
+        with open(f'{self.mirror}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.mirror.exists():
+                cmd = GIT_MIRROR_CLONE.format(url=self.url, mirror=self.mirror)
+            elif stamp.exists() and time.time() - stamp.stat().st_mtime < self.mirror_ttl:
+                LOG.debug(f'mirror for {self.name} is fresh, not fetching')
+                return
+            else:
+                cmd = GIT_MIRROR_FETCH.format(mirror=self.mirror)
+            TRACE.check_call(['/bin/bash', '-c', cmd])
+            stamp.touch()
+
+    def source(self):
+        if self.mirror is None:
+            return self.url
+        # depth/filter are ignored by git for plain local paths
+        return f'file://{self.mirror}' if self.shallow else str(self.mirror)
 
     def update(self):
-        cmd = GIT_UPDATE.format(branch=self.branch)
-        subprocess.call(['/bin/bash', '-c', cmd], cwd=self.srcdir)
+        if self.mirror is not None:
+            self.sync_mirror()
+        if self.mirror is None and not self.shallow:
+            cmd = GIT_UPDATE.format(branch=self.branch)
+        else:
+            cmd = GIT_UPDATE_FROM.format(fetch_opts=self.fetch_opts(),
+                                         source=self.source(),
+                                         branch=self.branch)
+        TRACE.check_call(['/bin/bash', '-c', cmd], cwd=self.srcdir)
 
     def clone(self):
-        cmd = GIT_CLONE.format(branch=self.branch,
-                               url=self.url,
-                               srcdir=self.srcdir.stem)
-        subprocess.call(['/bin/bash', '-c', cmd], cwd=self.topdir)
+        if self.mirror is not None:
+            self.sync_mirror()
+        if self.mirror is None and not self.shallow:
+            cmd = GIT_CLONE.format(branch=self.branch,
+                                   url=self.url,
+                                   srcdir=self.srcdir.stem)
+        else:
+            # full clones from the mirror borrow its objects via alternates
+            clone_opts = self.fetch_opts() if self.shallow else '--shared'
+            cmd = GIT_CLONE_FROM.format(clone_opts=clone_opts,
+                                        branch=self.branch,
+                                        source=self.source(),
+                                        url=self.url,
+                                        srcdir=self.srcdir.stem)
+        TRACE.check_call(['/bin/bash', '-c', cmd], cwd=self.topdir)
+
+    def head(self) -> str:
+        return TRACE.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.srcdir).decode().strip()
+
+    def revision(self) -> str:
+        '''HEAD of the working tree plus a digest of any local changes.'''
+        head = self.head()
+        local = TRACE.check_output(['git', 'status', '--porcelain'], cwd=self.srcdir)
+        if local:
+            local += TRACE.check_output(['git', 'diff', 'HEAD'], cwd=self.srcdir)
+            return '{}+{}'.format(head, hashlib.sha1(local).hexdigest()[:12])
+        return head
 
     def remote_hash(self):
-        cmd = GIT_LSREMOTE.format(url=self.url,
-                                  branch=self.branch)
-        try:
-            output = subprocess.check_output(['/bin/bash', '-c', cmd])
-        except subprocess.CalledProcessError:
-            output = None
-        if output:
-            return output.strip().split()[0]
+        return ref_resolver.ls_remote(self.url, [self.branch]).get(self.branch)
 
     def patch(self, patchfile):
         cmd = f'patch -N -p1 < {patchfile}'
         try:
-            subprocess.check_call(['/bin/bash', '-c', cmd], cwd=self.srcdir)
+            TRACE.check_call(['/bin/bash', '-c', cmd], cwd=self.srcdir)
         except subprocess.CalledProcessError as err:
             LOG.error(f'error appling patch {patchfile} to {self.srcdir}')
 
 
+class ref_resolver:
+    '''Resolve (url, ref) pairs to commit hashes, one git ls-remote per url.'''
+
+    def __init__(self, cache_file: Path = None, ttl: int = 600,
+                 lockfile: Path = None, pinned: bool = False, jobs: int = 4):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lockfile = lockfile
+        self.pinned = pinned
+        self.jobs = jobs
+        self.cache = {}
+        if cache_file is not None and cache_file.exists():
+            with cache_file.open('r') as fp:
+                self.cache = json.load(fp)
+        self.locked = {}
+        if lockfile is not None and lockfile.exists():
+            with lockfile.open('r') as fp:
+                self.locked = (yaml.safe_load(fp) or {}).get('refs', {})
+
+    @staticmethod
+    def ls_remote(url: str, refs: list) -> dict:
+        cmd = GIT_LSREMOTE.format(url=url, refs=' '.join(refs))
+        output = TRACE.check_output(['/bin/bash', '-c', cmd]).decode()
+        remote = {}
+        for line in output.splitlines():
+            if line.strip():
+                h, name = line.split()[:2]
+                remote[name] = h
+        resolved = {}
+        for ref in refs:
+            for name in [ref, f'refs/heads/{ref}', f'refs/tags/{ref}^{{}}', f'refs/tags/{ref}']:
+                if name in remote:
+                    resolved[ref] = remote[name]
+                    break
+            else:
+                tails = [h for name, h in remote.items() if name.endswith(f'/{ref}')]
+                if tails:
+                    resolved[ref] = tails[0]
+        return resolved
+
+    def resolve(self, refs: list) -> dict:
+        if self.pinned:
+            missing = [(url, ref) for url, ref in refs
+                       if ref not in self.locked.get(url, {})]
+            if missing:
+                raise SystemExit(f'refs not pinned in {self.lockfile}: {missing}')
+            return {(url, ref): self.locked[url][ref] for url, ref in refs}
+
+        now = time.time()
+        resolved = {}
+        wanted = {}
+        for url, ref in refs:
+            cached = self.cache.get(url, {}).get(ref)
+            if cached and now - cached[1] < self.ttl:
+                resolved[(url, ref)] = cached[0]
+            else:
+                wanted.setdefault(url, set()).add(ref)
+
+        if wanted:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                futures = {pool.submit(self.ls_remote, url, sorted(names)): url
+                           for url, names in wanted.items()}
+                for future in as_completed(futures):
+                    url = futures[future]
+                    for ref, h in future.result().items():
+                        resolved[(url, ref)] = h
+                        self.cache.setdefault(url, {})[ref] = [h, now]
+            self.save_cache()
+
+        missing = [(url, ref) for url, ref in refs if (url, ref) not in resolved]
+        if missing:
+            raise SystemExit(f'could not resolve refs: {missing}')
+        if self.lockfile is not None:
+            self.save_lockfile(resolved)
+        return resolved
+
+    def save_cache(self):
+        if self.cache_file is None:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with self.cache_file.open('w') as fp:
+            json.dump(self.cache, fp, indent=2)
+
+    def save_lockfile(self, resolved: dict):
+        for (url, ref), h in resolved.items():
+            self.locked.setdefault(url, {})[ref] = h
+        with self.lockfile.open('w') as fp:
+            yaml.safe_dump({'refs': self.locked}, fp)
+
+
+class bb_conf:
+    '''A bitbake configuration file (local.conf, bblayers.conf) as a list of statements.'''
+    ASSIGN_RE = re.compile(r'^\s*(?:export\s+)?(?P<var>[\w\-/\.:\[\]{}$~]+?)\s*'
+                           r'(?P<op>\?\?=|\?=|:=|\+=|=\+|\.=|=\.|=)')
+    VAR_REF_RE = re.compile(r'\$(?P<word>[\w_-]+)')
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.text = path.read_text() if path.exists() else ''
+        self.statements = self.parse(self.text)
+
+    @classmethod
+    def parse(cls, text: str) -> list:
+        statements = []
+        chunk = []
+        for line in text.splitlines(keepends=True):
+            chunk.append(line)
+            if line.rstrip('\n').endswith('\\'):
+                continue
+            statements.append(cls.statement(''.join(chunk)))
+            chunk = []
+        if chunk:
+            statements.append(cls.statement(''.join(chunk)))
+        return statements
+
+    @classmethod
+    def statement(cls, raw: str) -> dict:
+        m = cls.ASSIGN_RE.match(raw)
+        if m and not raw.lstrip().startswith('#'):
+            return {'raw': raw, 'var': m.group('var'), 'op': m.group('op')}
+        return {'raw': raw, 'var': None, 'op': None}
+
+    def apply(self, remove: list, values: dict):
+        '''Remove variables and set values ({var: (op, value)} or {var: None}) in one pass.'''
+        # a variable that is both removed and set is just set
+        remove = {var for var in remove if values.get(var) is None}
+        remove |= {var for var, value in values.items() if value is None}
+        seen = set()
+        statements = []
+        for stmt in self.statements:
+            var = stmt['var']
+            if var in remove:
+                continue
+            if var in values:
+                if var not in seen:
+                    seen.add(var)
+                    statements.append(self.assignment(var, *values[var]))
+                continue
+            statements.append(stmt)
+        for var, value in values.items():
+            if value is not None and var not in seen:
+                statements.append(self.assignment(var, *value))
+        self.statements = statements
+
+    @classmethod
+    def assignment(cls, var: str, op: str, value: str) -> dict:
+        return {'raw': f'{var} {op} "{value}"\n', 'var': var, 'op': op}
+
+    def ensure(self, line: str):
+        if not any(stmt['raw'].strip() == line for stmt in self.statements):
+            self.statements.append(self.statement(f'{line}\n'))
+
+    def render(self) -> str:
+        text = ''
+        for stmt in self.statements:
+            if text and not text.endswith('\n'):
+                text += '\n'
+            text += stmt['raw']
+        return text
+
+    def save(self) -> bool:
+        text = self.render()
+        if text == self.text:
+            return False
+        self.path.write_text(text)
+        self.text = text
+        return True
+
+
+class bitbake_session:
+    '''A build environment that is sourced once and reused for every command.'''
+
+    def __init__(self, source_cmd: str, rootfs_dir: Path, timeout: int = -1):
+        self.source_cmd = source_cmd
+        self.rootfs_dir = rootfs_dir
+        self.timeout = timeout
+        self.env = None
+
+    def start(self):
+        script = f'{self.source_cmd} > /dev/null && env -0'
+        output = TRACE.check_output(['/bin/bash', '-c', script], cwd=self.rootfs_dir.parent)
+        self.env = dict(item.split('=', 1) for item in output.decode().split('\0') if '=' in item)
+        self.env['BB_SERVER_TIMEOUT'] = str(self.timeout)
+        LOG.info(f'started bitbake session in {self.rootfs_dir}')
+
+    def command(self, *cmds):
+        return ['/bin/bash', '-c', '\n'.join(cmds)], {'cwd': self.rootfs_dir, 'env': self.env}
+
+    def close(self):
+        if self.env is None:
+            return
+        LOG.info('stopping bitbake server')
+        TRACE.call(['/bin/bash', '-c', 'bitbake -m'], cwd=self.rootfs_dir, env=self.env)
+        self.env = None
+
+
+class uboot_vab_build:
+    '''Incremental out-of-tree (O=) u-boot build for VAB images.'''
+
+    def __init__(self, src_dir: Path, out_dir: Path, defconfig: str,
+                 jobs: int = None, ccache: bool = True):
+        self.src_dir = Path(src_dir).absolute()
+        self.out_dir = Path(out_dir).absolute()
+        self.defconfig = defconfig
+        self.jobs = jobs
+        self.ccache = ccache and shutil.which('ccache') is not None
+
+    def make(self, *targets):
+        cmd = ['make', '-C', str(self.src_dir), f'O={self.out_dir}',
+               f'-j{self.jobs}' if self.jobs else '-j']
+        if self.ccache:
+            cross_compile = os.environ.get('CROSS_COMPILE', '')
+            cmd.append(f'CC=ccache {cross_compile}gcc')
+        RUNNER.run(f'{self.out_dir.name}-{"-".join(targets) or "build"}', cmd + list(targets))
+
+    def source_revision(self) -> str:
+        '''Commit of the source tree plus a digest of the patches bitbake applied on top.'''
+        try:
+            head = TRACE.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.src_dir,
+                                      stderr=subprocess.DEVNULL)
+            diff = TRACE.check_output(['git', 'diff', 'HEAD'], cwd=self.src_dir,
+                                      stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            return None
+        return f'{head.decode().strip()} {hashlib.sha256(diff).hexdigest()}'
+
+    def configure(self):
+        stamp = self.out_dir.joinpath('.meta-bake-config')
+        defconfig_file = self.src_dir.joinpath('configs', self.defconfig)
+        revision = self.source_revision()
+        config = (f'{self.src_dir}\n{self.defconfig}\n'
+                  f'{sha256sum(defconfig_file) if defconfig_file.exists() else None}\n{revision}\n')
+        # without a revision there is no telling whether the source changed
+        if (revision is not None and self.out_dir.joinpath('.config').exists() and stamp.exists()
+                and stamp.read_text() == config):
+            LOG.debug(f'u-boot in {self.out_dir} already configured with {self.defconfig}')
+            return
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.make(self.defconfig)
+        stamp.write_text(config)
+
+    def build(self):
+        self.configure()
+        self.make()
+
+    def relink_fit(self, payloads: list):
+        stamp = self.out_dir.joinpath('.meta-bake-payloads')
+        digest = '\n'.join(f'{Path(p).name} {sha256sum(p)}' for p in sorted(payloads))
+        if (self.out_dir.joinpath('u-boot.itb').exists() and stamp.exists()
+                and stamp.read_text() == digest):
+            LOG.info('signed payloads unchanged, not rebuilding u-boot.itb')
+            return
+        # the payloads are not prerequisites of u-boot.itb, so make would keep the old one
+        self.out_dir.joinpath('u-boot.itb').unlink(missing_ok=True)
+        stamp.unlink(missing_ok=True)
+        self.make('u-boot.itb')
+        stamp.write_text(digest)
+
+
+class vab_signer:
+    '''Sign HPS binaries for VAB with fcs_prepare and quartus_sign, each in its own work dir.'''
+
+    def __init__(self, fcs_prepare: str, quartus_sign: str, qky: str, pem: str,
+                 build_vab: str, family: str = 'agilex', cache_dir: Path = None):
+        self.fcs_prepare = fcs_prepare
+        self.quartus_sign = quartus_sign
+        self.qky = qky
+        self.pem = pem
+        self.build_vab = Path(build_vab)
+        self.family = family
+        self.cache_dir = cache_dir
+        self.signer_id = None
+        if cache_dir is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self.signer_id = self.get_signer_id()
+
+    def get_signer_id(self) -> str:
+        try:
+            quartus_version = TRACE.check_output([self.quartus_sign, '--version'],
+                                                      stderr=subprocess.DEVNULL)
+            quartus_version = quartus_version.decode().strip()
+        except (subprocess.CalledProcessError, OSError):
+            quartus_version = sha256sum(self.quartus_sign)
+        ids = [self.family,
+               sha256sum(self.qky),
+               sha256sum(self.pem),
+               sha256sum(self.fcs_prepare),
+               quartus_version]
+        return hashlib.sha256('\n'.join(ids).encode()).hexdigest()
+
+    def cache_file(self, fname: str) -> Path:
+        content = sha256sum(self.build_vab.joinpath(fname))
+        key = hashlib.sha256(f'{self.signer_id}:{content}'.encode()).hexdigest()
+        return self.cache_dir.joinpath(f'{key}.vab')
+
+    def sign_cached(self, fname: str) -> Path:
+        if self.cache_dir is None:
+            return self.sign(fname)
+        cache_file = self.cache_file(fname)
+        signed_bin = self.build_vab.joinpath(f'signed-{fname}')
+        if cache_file.exists():
+            LOG.debug(f'using cached signature for {fname}')
+            STAGER.stage(cache_file, signed_bin, link=True)
+            return signed_bin
+        self.sign(fname)
+        # matrix builds sign the same content from several threads at once
+        tmp_file = cache_file.with_suffix(f'.{os.uname().nodename}.{os.getpid()}.{threading.get_ident()}.tmp')
+        STAGER.stage(signed_bin, tmp_file, link=True)
+        os.replace(tmp_file, cache_file)
+        return signed_bin
+
+    def sign(self, fname: str) -> Path:
+        scratch = self.build_vab.joinpath('work', fname)
+        if scratch.exists():
+            shutil.rmtree(scratch)
+        scratch.mkdir(parents=True)
+        scratch.joinpath(fname).symlink_to(self.build_vab.joinpath(fname).absolute())
+
+        # create unsigned_cert.ccert
+        TRACE.check_call([self.fcs_prepare, '--hps_cert', fname, '-v'], cwd=scratch)
+
+        # create signed cert
+        signed_cert = f'signed_cert{fname}.ccert'
+        TRACE.check_call([self.quartus_sign, f'--family={self.family}',
+                               '--operation=SIGN', f'--qky={self.qky}',
+                               f'--pem={self.pem}', 'unsigned_cert.ccert',
+                               signed_cert], cwd=scratch)
+
+        # sign binary
+        TRACE.check_call([self.fcs_prepare, '--finish', signed_cert,
+                               '--imagefile', fname], cwd=scratch)
+
+        hps_image_signed = scratch.joinpath('hps_image_signed.vab')
+        if not hps_image_signed.exists():
+            raise RuntimeError(f'fcs_prepare did not create {hps_image_signed}')
+        signed_bin = self.build_vab.joinpath(f'signed-{fname}')
+        shutil.move(hps_image_signed, signed_bin)
+        shutil.rmtree(scratch)
+        return signed_bin
+
+    def timed_sign(self, fname: str):
+        start = time.monotonic()
+        with TRACE.span(f'sign {Path(fname).name}', 'sign'):
+            signed_bin = self.sign_cached(fname)
+        return signed_bin, time.monotonic() - start
+
+    def sign_all(self, fnames: list, jobs: int = 4) -> dict:
+        LOG.info(f'signing {len(fnames)} binaries with {jobs} workers')
+        signed = {}
+        timings = {}
+        failures = {}
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = {pool.submit(self.timed_sign, fname): fname for fname in fnames}
+            for future in as_completed(futures):
+                fname = futures[future]
+                try:
+                    signed[fname], timings[fname] = future.result()
+                except (subprocess.CalledProcessError, OSError, RuntimeError) as err:
+                    failures[fname] = err
+
+        for fname in fnames:
+            if fname in signed:
+                LOG.info(f'  {fname:<32} {timings[fname]:8.1f}s')
+            else:
+                LOG.error(f'  {fname:<32}   failed: {failures[fname]}')
+        if failures:
+            raise SystemExit(f'failed to sign: {", ".join(sorted(failures))}')
+        return signed
+
+
+class premirror:
+    '''Store of source tarballs bitbake tries before going upstream.'''
+
+    SCHEMES = ['git', 'gitsm', 'https?', 'ftp', 'svn', 'hg', 'bzr', 'npm']
+
+    def __init__(self, url: str, refresh: bool = False):
+        if url.startswith('file://') or '://' not in url:
+            self.dir = Path(url[len('file://'):] if url.startswith('file://') else url).expanduser().absolute()
+            self.url = f'file://{self.dir}/'
+        else:
+            self.dir = None
+            self.url = url
+        self.refresh = refresh
+        if refresh:
+            if self.dir is None:
+                raise SystemExit(f'premirror {url} is not local and cannot be refreshed')
+            self.dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def local_values(self) -> dict:
+        values = {'PREMIRRORS': ' '.join(f'{scheme}://.*/.* {self.url}' for scheme in self.SCHEMES)}
+        if self.refresh:
+            values['BB_GENERATE_MIRROR_TARBALLS'] = '1'
+        return values
+
+    def update(self, dl_dir: Path):
+        '''Copy the tarballs in dl_dir that the store does not have yet.'''
+        added = 0
+        with self.lock:
+            for src in Path(dl_dir).iterdir():
+                # clones, stamps and locks are recreated from the tarballs
+                if not src.is_file() or src.suffix in ['.done', '.lock'] or src.name.startswith('.'):
+                    continue
+                dst = self.dir.joinpath(src.name)
+                if dst.exists() and dst.stat().st_size == src.stat().st_size:
+                    continue
+                # other hosts may be reading the store, so only complete files appear in it
+                tmp = self.dir.joinpath(f'.{src.name}.{os.uname().nodename}.{os.getpid()}')
+                STAGER.stage(src, tmp)
+                os.rename(tmp, dst)
+                added += 1
+        LOG.info(f'added {added} tarballs from {dl_dir} to the premirror {self.dir}')
+
+
+class hashserv:
+    '''A bitbake-hashserv instance shared by several build directories.'''
+
+    def __init__(self, poky_dir: Path, socket: Path, database: Path):
+        self.hashserv = Path(poky_dir).absolute().joinpath('bitbake', 'bin', 'bitbake-hashserv')
+        self.socket = Path(socket).absolute()
+        self.database = Path(database).absolute()
+        self.proc = None
+
+    @property
+    def address(self):
+        return f'unix://{self.socket}'
+
+    def start(self, timeout: float = 30):
+        self.socket.unlink(missing_ok=True)
+        self.database.parent.mkdir(parents=True, exist_ok=True)
+        self.proc = subprocess.Popen([str(self.hashserv), '--bind', self.address,
+                                      '--database', str(self.database)])
+        deadline = time.monotonic() + timeout
+        while not self.socket.exists():
+            if self.proc.poll() is not None or time.monotonic() > deadline:
+                self.stop()
+                raise SystemExit(f'could not start {self.hashserv}')
+            time.sleep(0.1)
+        LOG.info(f'started hash equivalence server at {self.address}')
+
+    def stop(self):
+        if self.proc is None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.proc = None
+        self.socket.unlink(missing_ok=True)
+
+
+FCS_PREPARE_LOCK = threading.Lock()
+
+
+def build_fcs_prepare(repo: git_repo) -> str:
+    '''Build fcs_prepare (make only redoes what changed), returns its path.'''
+    with FCS_PREPARE_LOCK:
+        RUNNER.run('fcs_prepare', ['make'], cwd=repo.srcdir)
+    return os.path.abspath(os.path.join(repo.srcdir, 'fcs_prepare'))
+
+
 class bitbaker:
-    var_assign_re = re.compile(r'^(:?export)?\s*(\w+)="\s*([\w_\-/\.\+]+)\s*"\s*$',
-                               re.MULTILINE)
+    env_function_re = re.compile(r'^(?:python\s+)?[\w\-\.\+:${}]+\s*\(\)\s*\{$')
+    # BB_PRESSURE_MAX_* are only read by bitbake 2.0 (kirkstone) and later
+    PRESSURE_VERSION = [2, 0]
 
-    def __init__(self, poky_dir: Path, rootfs_dir: Path, build_dir: Path) -> None:
+    def __init__(self, poky_dir: Path, rootfs_dir: Path, build_dir: Path, repos: list = ()) -> None:
         self.poky_dir = poky_dir.absolute()
         self.rootfs_dir = rootfs_dir.absolute()
         self.build_dir = build_dir.absolute()
+        self.repos = list(repos)
+        self.env_cache = {}
+        self.query_lock = threading.Lock()
+        self.session = None
         oe_init_build_env = self.poky_dir.joinpath('oe-init-build-env')
         self.source_cmd = f'source {oe_init_build_env} {self.rootfs_dir}'
 
+    def start_session(self, timeout: int = -1):
+        self.session = bitbake_session(self.source_cmd, self.rootfs_dir, timeout)
+        self.session.start()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
     def with_env(self, *cmds):
         script = '\n'.join([self.source_cmd] + list(cmds))
         return script
 
-    def run(self, *cmds, **kwargs):
+    def command(self, *cmds, **kwargs):
+        if self.session is not None:
+            return self.session.command(*cmds)
         script = self.with_env(*cmds)
-        cmd = ['/bin/bash', '-c', script]
-        cwd = kwargs.pop('cwd', self.build_dir)
-        return subprocess.call(cmd, cwd=cwd)
+        return ['/bin/bash', '-c', script], {'cwd': kwargs.pop('cwd', self.build_dir)}
+
+    def run(self, *cmds, **kwargs):
+        cmd, popen_kwargs = self.command(*cmds, **kwargs)
+        return TRACE.call(cmd, **popen_kwargs)
+
+    def run_step(self, name: str, *cmds, **kwargs):
+        cmd, popen_kwargs = self.command(*cmds, **kwargs)
+        return RUNNER.run(f'{name}-{self.rootfs_dir.name}', cmd, **popen_kwargs)
 
     def initialize(self, cfg: dict, args: argparse.Namespace, ctx: dict):
-        # run once to create the conf files
-        self.run()
+        # run once to create the conf files (a session has already done this)
+        if self.session is None:
+            self.run()
 
         self.update_local_conf(cfg, ctx)
         self.update_bblayers(cfg)
 
+    def bitbake_version(self) -> list:
+        init = self.poky_dir.joinpath('bitbake', 'lib', 'bb', '__init__.py')
+        try:
+            m = re.search(r'^__version__\s*=\s*["\'](?P<version>[\d.]+)', init.read_text(), re.M)
+        except OSError:
+            return None
+        return dot_version(m.group('version')).num_version if m else None
+
     def update_local_conf(self, cfg: dict, ctx: dict):
-        local_conf = self.rootfs_dir.joinpath('conf/local.conf')
-        with local_conf.open('r') as fp:
-            conf_text = fp.read()
+        local_conf = bb_conf(self.rootfs_dir.joinpath('conf/local.conf'))
 
         def resolve(m):
             key = m.group('word')
             return ctx.get(key, f'${key}')
         local_cfg = cfg.get('local', {})
-        for key in local_cfg.get('remove', []):
-            conf_text = re.sub(f'${key}.*=.*', '', conf_text)
-
+        values = {}
         for k, v in local_cfg.get('values', {}).items():
             if v is None:
-                conf_text = re.sub(f'${k}.*=.*', '', conf_text)
+                values[k] = None
+                continue
+            v = str(v)
+            if v.startswith('+='):
+                op = "+="
+                v = v.strip("+=")
             else:
-                if v.startswith('+='):
-                    op = "+="
-                    v = v.strip("+=")
-                else:
-                    op = "="
-                value = re.sub('\$(?P<word>[\w_-]+)', resolve, v)
-                if re.findall(f'^{k}\s+\+?=.*', conf_text, re.MULTILINE):
-                    conf_text = re.sub(f'{k}.*?=.*', f'{k} {op} "{value}"',
-                                       conf_text, re.MULTILINE)
-                else:
-                    conf_text += f'{k} {op} "{value}"\n'
-
-        conf_text = re.sub('\$(?P<word>[\w_-]+)', resolve, conf_text)
+                op = "="
+            values[k] = (op, bb_conf.VAR_REF_RE.sub(resolve, v))
+
+        version = self.bitbake_version()
+        if version is not None and version < self.PRESSURE_VERSION:
+            for k in values:
+                if k.startswith('BB_PRESSURE_MAX_'):
+                    LOG.debug(f'bitbake {".".join(map(str, version))} does not support {k}, leaving it out')
+                    values[k] = None
+        local_conf.apply(local_cfg.get('remove', []), values)
         # TODO: add "reguire/conf/machine/*-extra.conf" to conf_text
-        with local_conf.open('w') as fp:
-            fp.write(conf_text)
+        if local_conf.save():
+            LOG.debug(f'updated {local_conf.path}')
+        else:
+            LOG.debug(f'{local_conf.path} is up to date')
 
     def update_bblayers(self, cfg: dict):
         repos = cfg.get('repos', [])
 
-        bblayers_conf = self.rootfs_dir.joinpath('conf/bblayers.conf')
-        with bblayers_conf.open('r') as fp:
-            bblayers_text = fp.read()
+        bblayers_conf = bb_conf(self.rootfs_dir.joinpath('conf/bblayers.conf'))
         for repo in repos:
             add_layers = repo.get('add_layers')
             if add_layers is None:
@@ -200,10 +1637,11 @@ class bitbaker:
             else:
                 bblayers_add = [f'{prefix} "']
             for line in bblayers_add:
-                if line not in bblayers_text:
-                    bblayers_text += f'{line}\n'
-        with bblayers_conf.open('w') as fp:
-            fp.write(bblayers_text)
+                bblayers_conf.ensure(line)
+        if bblayers_conf.save():
+            LOG.debug(f'updated {bblayers_conf.path}')
+        else:
+            LOG.debug(f'{bblayers_conf.path} is up to date')
 
     def build(self, target, clean=False):
         if clean:
@@ -213,25 +1651,140 @@ class bitbaker:
         else:
             cmds = []
         cmds.append(f'bitbake {target}')
-        self.run(*cmds)
+        self.run_step('bitbake', *cmds)
+
+    def fetch(self, target):
+        self.run_step('fetch', f'bitbake {target} --runall=fetch')
+
+    def env_fingerprint(self) -> str:
+        '''Digest of everything a bitbake -e result depends on.'''
+        digest = hashlib.sha256()
+        for conf in ['conf/local.conf', 'conf/bblayers.conf']:
+            conf_file = self.rootfs_dir.joinpath(conf)
+            if conf_file.exists():
+                digest.update(conf_file.read_bytes())
+        for repo in self.repos:
+            digest.update(f'{repo.name}={repo.revision()}'.encode())
+        return digest.hexdigest()[:16]
 
-    def get_target_env(self, target):
-        script = self.with_env(f'bitbake -e {target}')
+    @classmethod
+    def parse_env(cls, lines):
+        '''Yield (name, value) for every variable in bitbake -e output.'''
+        lines = iter(lines)
+        for line in lines:
+            if line.startswith('#') or not line.strip():
+                continue
+            line = line.rstrip('\n')
+            if line.endswith('{') and cls.env_function_re.match(line):
+                for line in lines:
+                    if line.rstrip('\n') == '}':
+                        break
+                continue
+            name, sep, value = line.partition('=')
+            if name.startswith('export '):
+                name = name[len('export '):]
+            if not sep or not name or any(c in name for c in ' \t#'):
+                continue
+            if value.startswith('"'):
+                value = value[1:]
+                while not (value.endswith('"') and not value.endswith('\\"')):
+                    line = next(lines, None)
+                    if line is None:
+                        break
+                    line = line.rstrip('\n')
+                    value = f'{value}\n{line}'
+                else:
+                    value = value[:-1]
+                if '\\' in value:
+                    value = value.replace(' \\\n', '\n').replace('\\"', '"').replace('\\$', '$')
+            yield name, value
+
+    def query_target_env(self, target, names=None):
+        '''Run bitbake -e for target, stopping once all names have been seen.'''
+        cmd, popen_kwargs = self.command(f'bitbake -e {target}')
+        wanted = set(names or ())
         data = {}
-        try:
-            output = subprocess.check_output(
-                ['/bin/bash', '-c', script], cwd=self.build_dir).decode()
-        except subprocess.CalledProcessError:
-            return data
-        for m in self.var_assign_re.finditer(output):
-            data[m.group(2)] = m.group(3)
+        stopped = False
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, errors='replace', text=True,
+                                start_new_session=True, **popen_kwargs)
+        for name, value in self.parse_env(proc.stdout):
+            if not wanted or name in wanted:
+                data[name] = value
+                if wanted and wanted <= data.keys():
+                    stopped = True
+                    break
+        if stopped:
+            os.killpg(proc.pid, signal.SIGTERM)
+        proc.stdout.close()
+        returncode = TRACE.wait(proc, cmd, popen_kwargs.get('cwd'), start)
+        if returncode and not stopped:
+            LOG.error(f'bitbake -e {target} failed with exit code {returncode}')
+            return {}
         return data
 
+    def get_target_env(self, target, names=None):
+        return self.get_target_envs((target, names))[0]
+
+    def get_target_envs(self, *queries):
+        '''Get the bitbake environment of each target (or (target, names) tuple).
+
+        Cached under .meta-bake/env, misses are queried one at a time per build dir.
+        '''
+        queries = [(q, None) if isinstance(q, str) else q for q in queries]
+        fingerprint = self.env_fingerprint()
+        cache_root = self.build_dir.joinpath('.meta-bake', 'env', self.rootfs_dir.name)
+        cache_dir = cache_root.joinpath(fingerprint)
+
+        def cache_file(target):
+            return cache_dir.joinpath(target.replace('/', '_') + '.json')
+
+        def satisfies(cached, names):
+            # partial environments only hold what earlier callers asked for
+            return cached['complete'] or (names and all(n in cached['vars'] for n in names))
+
+        cached = {}
+        missing = []
+        for target, names in queries:
+            entry = self.env_cache.get((target, fingerprint))
+            if entry is None and cache_file(target).exists():
+                with cache_file(target).open('r') as fp:
+                    entry = json.load(fp)
+            if entry is not None and 'vars' in entry:
+                cached[target] = entry
+            if target not in cached or not satisfies(cached[target], names):
+                missing.append((target, names))
+
+        if missing:
+            with self.query_lock:
+                for target, names in missing:
+                    env = self.query_target_env(target, names)
+                    if not env:
+                        cached.setdefault(target, {'complete': False, 'vars': {}})
+                        continue
+                    entry = cached.get(target, {'complete': False, 'vars': {}})
+                    # a named query only keeps the names it asked for, found or not
+                    cached[target] = {'complete': entry['complete'] or names is None,
+                                      'vars': {**entry['vars'], **env}}
+            if cache_root.exists():
+                for stale in cache_root.iterdir():
+                    if stale.name != fingerprint:
+                        shutil.rmtree(stale, ignore_errors=True)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            for target, _ in missing:
+                if cached[target]['vars']:
+                    with cache_file(target).open('w') as fp:
+                        json.dump(cached[target], fp)
+
+        for target, _ in queries:
+            if cached[target]['vars']:
+                self.env_cache[(target, fingerprint)] = cached[target]
+        return [cached[target]['vars'] for target, _ in queries]
+
     def make_fit(self, target, ctx: dict):
-        LOG.info('getting environment for uboot')
-        uboot_env = self.get_target_env('virtual/bootloader')
-        LOG.info(f'getting environment for {target}')
-        image_env = self.get_target_env(target)
+        LOG.info(f'getting environment for uboot and {target}')
+        uboot_env, image_env = self.get_target_envs(('virtual/bootloader', UBOOT_ENV_VARS),
+                                                    (target, IMAGE_ENV_VARS))
         uboot_src_dir = uboot_env['S']
         uboot_bin_dir = uboot_env['B']
         uboot_config = 'socfpga_{machine}_{image}_defconfig'.format(**ctx)
@@ -240,9 +1793,11 @@ class bitbaker:
         # print(f'uboot_bin={uboot_bin_dir}')
         cpio = '{DEPLOY_DIR_IMAGE}/{IMAGE_BASENAME}-{machine}.cpio'.format(**image_env, **ctx)
         # print(f'cpio={cpio}')
-        shutil.copy(cpio, uboot_make_dir.joinpath('rootfs.cpio'))
+        STAGER.stage(cpio, uboot_make_dir.joinpath('rootfs.cpio'), link=True)
         LOG.debug(f'Making uboot in: {uboot_make_dir}')
-        subprocess.run(['make'], cwd=uboot_make_dir)
+        jobs = ctx.get('make_jobs')
+        RUNNER.run(f'make-fit-{self.rootfs_dir.name}', ['make'] + ([f'-j{jobs}'] if jobs else []),
+                   cwd=uboot_make_dir)
         itb = uboot_make_dir.joinpath('u-boot.itb')
         spl = uboot_make_dir.joinpath('spl/u-boot-spl-dtb.hex')
         return (itb, spl)
@@ -257,11 +1812,9 @@ class bitbaker:
             LOG.error('No fcs_prepare repo specified')
             return False
 
-        # Build fcs_prepare
+        # Build fcs_prepare (normally already done by the fcs_prepare step)
         print(" fcs_prepare.srcdir", fcs_prepare.srcdir)
-        subprocess.run(['make'], cwd=fcs_prepare.srcdir)
-        fcs_prepare = os.path.abspath('{}/{}/{}'.format(os.getcwd(),
-                                                        fcs_prepare.srcdir, "fcs_prepare"))
+        fcs_prepare = build_fcs_prepare(fcs_prepare)
         print("fcs_prepare:", fcs_prepare)
 
         uboot_dtb = cfg.get('uboot-dtb')
@@ -272,23 +1825,27 @@ class bitbaker:
         print("build_dir:", args.build_dir)
 
         # create vab build dir
-        build_vab = os.path.abspath('{}/{}'.format(args.build_dir, "vab"))
+        build_vab = os.path.abspath('{}/{}'.format(args.build_dir, ctx.get('vab_dir', "vab")))
         print("build_vab:", build_vab)
         if os.path.exists(build_vab):
             shutil.rmtree(build_vab)
         os.mkdir(build_vab)
 
-        # remove uboot-socfpga-vab-n6000 dir
-        uboot_vab = os.path.abspath('{}/{}'.format(args.build_dir, "uboot-socfpga-vab-n6000"))
+        # remove uboot-socfpga-vab-n6000 dir (kept as the O= dir when incremental)
+        incremental = args.vab_incremental or cfg.get('vab-incremental', False)
+        uboot_vab = os.path.abspath('{}/{}'.format(args.build_dir,
+                                                   ctx.get('uboot_vab_dir', "uboot-socfpga-vab-n6000")))
         print("uboot_vab:", uboot_vab)
-        if os.path.exists(uboot_vab):
+        if os.path.exists(uboot_vab) and not incremental:
+            shutil.rmtree(uboot_vab)
+        elif os.path.exists(uboot_vab) and os.path.exists(os.path.join(uboot_vab, 'Kconfig')):
+            # an in-tree copy from a non-incremental run can't be used with O=
             shutil.rmtree(uboot_vab)
 
         # uboot env
-        LOG.info('getting environment for uboot')
-        uboot_env = self.get_target_env('virtual/bootloader')
-        LOG.info(f'getting environment for {target}')
-        image_env = self.get_target_env(target)
+        LOG.info(f'getting environment for uboot and {target}')
+        uboot_env, image_env = self.get_target_envs(('virtual/bootloader', UBOOT_ENV_VARS),
+                                                    (target, IMAGE_ENV_VARS))
         uboot_src_dir = uboot_env['S']
         uboot_bin_dir = uboot_env['B']
         uboot_config = 'socfpga_{machine}_{image}_defconfig'.format(**ctx)
@@ -298,13 +1855,14 @@ class bitbaker:
         print(f'uboot_make_dir={uboot_make_dir}')
 
         # copy uboot src to folder uboot-socfpga-vab-n6000
-        shutil.copytree(uboot_src_dir, uboot_vab)
+        if not incremental:
+            shutil.copytree(uboot_src_dir, uboot_vab)
 
         for fname in linux_binary:
             print(fname)
             # copy unsinged files
             print("path ", uboot_make_dir.joinpath(fname))
-            shutil.copy(uboot_make_dir.joinpath(fname), build_vab)
+            STAGER.stage(uboot_make_dir.joinpath(fname), build_vab, link=True)
 
         # quartus path
         quartus_path = os.path.abspath('{}/{}'.format(args.quartus,
@@ -336,78 +1894,45 @@ class bitbaker:
             return False
 
         # build u-boot
-        ret_value = subprocess.run(["make", "clean"], cwd=uboot_vab)
-        if not ret_value:
-            print("Failed to make clean uboot soruce code ", ret_value)
-
-        ret_value = subprocess.run(["make", "mrproper"], cwd=uboot_vab)
-        if not ret_value:
-            print("Failed to make mrproper uboot soruce code ", ret_value)
-
-        ret_value = subprocess.run(["make", "socfpga_agilex_n6000_vab_defconfig"], cwd=uboot_vab)
-        if not ret_value:
-            print("Failed to make socfpga_agilex_n6000_vab_defconfig ", ret_value)
-
-        ret_value = subprocess.run(["make", "-j"], cwd=uboot_vab)
-        if not ret_value:
-            print("Failed to make uboot ", ret_value)
+        jobs = ctx.get('make_jobs')
+        if incremental:
+            uboot_build = uboot_vab_build(uboot_src_dir, uboot_vab, UBOOT_VAB_DEFCONFIG,
+                                          jobs=jobs, ccache=not args.no_ccache)
+            uboot_build.build()
+        else:
+            step = os.path.basename(uboot_vab)
+            # a freshly copied tree may have nothing to clean
+            if RUNNER.run(f'{step}-clean', ["make", "clean"], check=False, cwd=uboot_vab):
+                LOG.warning('Failed to make clean uboot source code')
+            if RUNNER.run(f'{step}-mrproper', ["make", "mrproper"], check=False, cwd=uboot_vab):
+                LOG.warning('Failed to make mrproper uboot source code')
+            RUNNER.run(f'{step}-defconfig', ["make", UBOOT_VAB_DEFCONFIG], cwd=uboot_vab)
+            RUNNER.run(f'{step}-build', ["make", f'-j{jobs}' if jobs else '-j'], cwd=uboot_vab)
 
         for fname in uboot_dtb:
             print(fname)
             # copy unsinged bin files
-            shutil.copy(str(uboot_vab + "/" + fname), build_vab)
+            STAGER.stage(str(uboot_vab + "/" + fname), build_vab)
 
         hps_binary = uboot_dtb + linux_binary
-        # Sign uboot binary
+        # Sign uboot and linux binaries
+        sign_cache = None
+        if not args.no_sign_cache:
+            sign_cache = args.sign_cache or state_dir(args).joinpath('sign-cache')
+        signer = vab_signer(fcs_prepare, quartus_path, root_public_qky, root_private_pem, build_vab,
+                            cache_dir=sign_cache)
+        signed = signer.sign_all(hps_binary, args.sign_jobs)
         for fname in hps_binary:
-            print(fname)
-
-            # delete unsigned_cert.cert
-            unsigned_cert_path = build_vab + "/" + "unsigned_cert.ccert"
-            print("unsigned_cert_path:", unsigned_cert_path)
-            if os.path.exists(unsigned_cert_path):
-                os.remove(unsigned_cert_path)
-
-            # create unsigned_cert.ccert
-            p1 = subprocess.check_call(args=[fcs_prepare,
-                                       '--hps_cert', fname, '-v'], cwd=build_vab)
-
-            # create signed cert
-            signed_cert = 'signed_cert{}.ccert'.format(fname)
-            # print(" signed_cert:",signed_cert)
-            signed_cert_path = build_vab + "/" + signed_cert
-            p1 = subprocess.check_call(args=[quartus_path, '--family=agilex',
-                                       '--operation=SIGN', str('--qky=' + root_public_qky),
-                                       str('--pem=' + root_private_pem), unsigned_cert_path,
-                                       signed_cert], cwd=build_vab)
-
-            # Sign binary
-            p1 = subprocess.check_call(args=[fcs_prepare, '--finish', signed_cert_path,
-                                       '--imagefile', fname], cwd=build_vab)
-
-            signed_bin = 'signed-{}'.format(fname)
-            # print(" signed_bin:",signed_bin)
-            hps_image_signed = build_vab + "/" + "hps_image_signed.vab"
-            if os.path.exists(hps_image_signed):
-                shutil.move(hps_image_signed, build_vab + "/" + signed_bin)
-
-            if os.path.exists(signed_cert_path):
-                os.remove(signed_cert_path)
-            if os.path.exists(unsigned_cert_path):
-                os.remove(unsigned_cert_path)
-
-            print(build_vab + "/" + signed_bin)
-            shutil.copy(build_vab + "/" + signed_bin, uboot_vab)
+            print(signed[fname])
+            STAGER.stage(signed[fname], uboot_vab, link=True)
 
         # Build VAB enabled uboot
-        # print("uboot_vab:", uboot_vab)
-        ret_value = subprocess.run(["make", "socfpga_agilex_n6000_vab_defconfig"], cwd=uboot_vab)
-        if not ret_value:
-            print("Failed to make socfpga_agilex_n6000_vab_defconfig ", ret_value)
-
-        ret_value = subprocess.run(["make", "-j"], cwd=uboot_vab)
-        if not ret_value:
-            print("Failed to make uboot ", ret_value)
+        if incremental:
+            uboot_build.relink_fit([signed[fname] for fname in hps_binary])
+        else:
+            # print("uboot_vab:", uboot_vab)
+            RUNNER.run(f'{step}-defconfig', ["make", UBOOT_VAB_DEFCONFIG], cwd=uboot_vab)
+            RUNNER.run(f'{step}-build', ["make", f'-j{jobs}' if jobs else '-j'], cwd=uboot_vab)
 
         # print("images_dir ",images_dir)
         uboot_userkey_vab = os.path.abspath('{}/{}'.format(images_dir,
@@ -418,19 +1943,31 @@ class bitbaker:
 
         # print("uboot_userkey_vab ",uboot_userkey_vab)
         # print("uboot_stl_vab ",uboot_stl_vab)
-        shutil.copy(uboot_vab + "/" + "u-boot.itb", uboot_userkey_vab)
-        shutil.copy(uboot_vab + "/spl/u-boot-spl-dtb.hex", uboot_stl_vab)
+        STAGER.stage(uboot_vab + "/" + "u-boot.itb", uboot_userkey_vab)
+        STAGER.stage(uboot_vab + "/spl/u-boot-spl-dtb.hex", uboot_stl_vab)
 
         return True
 
 
-def get_meta(cfg: dict, args: argparse.Namespace) -> dict:
-    repos = {}
-    for r in cfg.get('repos', []):
-        name = r['name']
-        keep = r.pop('keep', False) or name in args.keep
-        repo = git_repo(**r, topdir=args.build_dir)
-        patch = r.get('patch')
+def state_dir(args: argparse.Namespace) -> Path:
+    path = args.build_dir.joinpath('.meta-bake')
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def find_patch(patch: str, args: argparse.Namespace) -> Path:
+    patch_file = Path(patch)
+    conf_dir = Path(args.conf.name).absolute().parent
+    if not patch_file.exists():
+        patch_file = conf_dir.joinpath(patch)
+    if patch_file.exists():
+        return patch_file.absolute()
+    LOG.warn(f'patch file, {patch}, not found')
+
+
+def sync_repo(repo: git_repo, keep: bool, patch: str, args: argparse.Namespace) -> float:
+    start = time.monotonic()
+    with TRACE.span(f'sync {repo.name}', 'sync'):
         if repo.srcdir.exists():
             if not keep:
                 repo.update()
@@ -440,50 +1977,86 @@ def get_meta(cfg: dict, args: argparse.Namespace) -> dict:
             repo.clone()
 
         if patch is not None:
-            patch_file = Path(patch)
-            conf_dir = Path(args.conf.name).absolute().parent
-            if not patch_file.exists():
-                patch_file = conf_dir.joinpath(patch)
-            if patch_file.exists():
-                repo.patch(patch_file.absolute())
-            else:
-                LOG.warn(f'patch file, {patch}, not found')
+            patch_file = find_patch(patch, args)
+            if patch_file is not None:
+                repo.patch(patch_file)
+    return time.monotonic() - start
+
+
+def get_repos(cfg: dict, args: argparse.Namespace):
+    '''Make a git_repo for each repo in cfg, returns them and the sync jobs.'''
+    repos = {}
+    jobs = []
+    mirror_cfg = cfg.get('git_mirror', {})
+    defaults = {'mirror': args.git_mirror or mirror_cfg.get('path'),
+                'mirror_ttl': args.mirror_refresh or mirror_cfg.get('refresh', 3600)}
+    for r in cfg.get('repos', []):
+        name = r['name']
+        keep = r.pop('keep', False) or name in args.keep
+        repo = git_repo(**{**defaults, **r}, topdir=args.build_dir)
+        jobs.append((repo, keep, r.get('patch')))
         repos[name] = repo
+    return repos, jobs
+
+
+def get_meta(cfg: dict, args: argparse.Namespace) -> dict:
+    repos, jobs = get_repos(cfg, args)
+    sync_repos(repos, jobs, cfg, args)
     return repos
 
 
+def sync_repos(repos: dict, jobs: list, cfg: dict, args: argparse.Namespace):
+    workers = max(1, min(args.sync_jobs or cfg.get('sync_jobs', 4), len(jobs) or 1))
+    LOG.info(f'syncing {len(jobs)} repos with {workers} workers')
+    timings = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(sync_repo, repo, keep, patch, args): repo.name
+                   for repo, keep, patch in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                timings[name] = future.result()
+            except Exception as err:
+                # every repo is reported below, not just the first to fail
+                failures[name] = err
+
+    for name in repos:
+        if name in timings:
+            LOG.info(f'  {name:<32} {timings[name]:8.1f}s')
+        else:
+            LOG.error(f'  {name:<32}   failed: {failures[name]}')
+    if failures:
+        raise SystemExit(f'failed to sync repos: {", ".join(sorted(failures))}')
+
+
 def find_bb_file(name: str, version_str: str, meta_project: git_repo, bb_dir: str) -> Path:
     bb_files = meta_project.srcdir.joinpath(bb_dir)
-    bb_file = bb_files.joinpath(f'{name}-v{version_str}.bb')
-    if bb_file.exists():
-        return bb_file
-    else:
-        version = dot_version(version_str)
-        bb_matches = list(bb_files.glob(f'{name}?v*.bb'))
-        for bb_file in bb_matches:
-            versions = list(dot_version.get(str(bb_file)))
-            if versions:
-                version_tpl = versions[0].num_version
-                if version.num_version[:len(version_tpl)] == version_tpl:
-                    return bb_file
-    # can't find file with version, use last one
-    last = sorted(bb_matches)[-1]
-    LOG.warn(f'cannot find recipe named for version {version_str}, using {last.stem}')
-    return last
-
-
-def insert_hash_srcrev(ext_project: dict, meta_project: git_repo, version_field: str, bb_dir: str):
+    return recipe_index.find(bb_files, name, version_str)
+
+
+def insert_hash_srcrev(ext_project: dict, meta_project: git_repo, version_field: str, bb_dir: str,
+                       srcrev: str):
     name = ext_project['name']
     version_str = str(ext_project['version'])
     bb_file = find_bb_file(name, version_str, meta_project, bb_dir)
-    if bb_file:
-        repo = git_repo(**ext_project)
-        h = repo.remote_hash().decode()
-        with bb_file.open('r') as fp:
-            text = re.sub('SRCREV = .*', f'SRCREV = "{h}"', fp.read())
-            text = re.sub(f'{version_field} = .*', f'{version_field} = "v{version_str}"', text)
-        with bb_file.open('w') as fp:
-            fp.write(text)
+    with bb_file.open('r') as fp:
+        orig_text = fp.read()
+    text = re.sub('SRCREV = .*', f'SRCREV = "{srcrev}"', orig_text)
+    text = re.sub(f'{version_field} = .*', f'{version_field} = "v{version_str}"', text)
+    # leave the file (and bitbake's parse cache) alone when nothing changed
+    if text == orig_text:
+        LOG.debug(f'{bb_file.name} already at {srcrev}')
+        return
+    with bb_file.open('w') as fp:
+        fp.write(text)
+
+
+def get_resolver(args: argparse.Namespace) -> ref_resolver:
+    return ref_resolver(cache_file=state_dir(args).joinpath('remote-refs.json'),
+                        ttl=args.ref_ttl,
+                        lockfile=args.lockfile,
+                        pinned=args.pinned)
 
 
 def update_meta(cfg: dict, repos: dict, args: argparse.Namespace):
@@ -493,23 +2066,667 @@ def update_meta(cfg: dict, repos: dict, args: argparse.Namespace):
     uboot_version_info = v_info.get('uboot', {})
     atf_version_info = v_info.get('atf', {})
 
+    ingredients = {}
     linux_version = dot_version(linux_version_info.get('version', ''))
     if linux_version.num_version == (5, 4):
-        insert_hash_srcrev(linux_version_info,
-                           intel_meta,
-                           'LINUX_VERSION',
-                           'recipes-kernel/linux')
+        ingredients['linux'] = (linux_version_info,
+                                intel_meta,
+                                'LINUX_VERSION',
+                                'recipes-kernel/linux')
 
     if uboot_version_info and not uboot_version_info.pop('disabled', False):
-        insert_hash_srcrev(uboot_version_info,
-                           intel_fpga,
-                           'UBOOT_VERSION',
-                           'recipes-bsp/u-boot')
+        ingredients['uboot'] = (uboot_version_info,
+                                intel_fpga,
+                                'UBOOT_VERSION',
+                                'recipes-bsp/u-boot')
     if atf_version_info and not atf_version_info.pop('disabled', False):
-        insert_hash_srcrev(atf_version_info,
-                           intel_fpga,
-                           'ATF_VERSION',
-                           'recipes-bsp/arm-trusted-firmware')
+        ingredients['atf'] = (atf_version_info,
+                              intel_fpga,
+                              'ATF_VERSION',
+                              'recipes-bsp/arm-trusted-firmware')
+
+    refs = {key: (info['url'], info.get('branch', 'master'))
+            for key, (info, *_) in ingredients.items()}
+    resolved = get_resolver(args).resolve(list(refs.values()))
+    srcrevs = {}
+    for key, (info, meta_project, version_field, bb_dir) in ingredients.items():
+        srcrevs[key] = resolved[refs[key]]
+        insert_hash_srcrev(info, meta_project, version_field, bb_dir, srcrevs[key])
+    return srcrevs
+
+
+# recipes to clean when one of the ingredients or the layers change
+INGREDIENT_RECIPES = {'linux': ['virtual/kernel'],
+                      'uboot': ['u-boot-socfpga'],
+                      'atf': ['arm-trusted-firmware']}
+LAYER_RECIPES = ['virtual/kernel', 'u-boot-socfpga', 'hw-ref-design']
+
+
+def get_fingerprint(cfg: dict, repos: dict, srcrevs: dict, ctx: dict,
+                    args: argparse.Namespace) -> dict:
+    '''Digest of each input of a build that cleanup decisions depend on.'''
+    def digest(data):
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    fingerprint = {'conf': digest({'local': cfg.get('local', {}),
+                                   'layers': [(r['name'], r.get('add_layers'))
+                                              for r in cfg.get('repos', [])],
+                                   'ctx': ctx})}
+    for r in cfg.get('repos', []):
+        name = r['name']
+        patch = r.get('patch')
+        patch_file = find_patch(patch, args) if patch else None
+        fingerprint[f'repo:{name}'] = digest([repos[name].head(),
+                                              sha256sum(patch_file) if patch_file else None])
+    for key, srcrev in srcrevs.items():
+        fingerprint[f'srcrev:{key}'] = srcrev
+    return fingerprint
+
+
+def plan_cleanup(old: dict, new: dict):
+    '''Decide what to clean from the fingerprints of the last and this run.
+
+    Returns (full, conf, recipes).
+    '''
+    if not old or old.get('repo:poky') != new.get('repo:poky'):
+        return True, True, []
+    changed = [key for key in set(old) | set(new) if old.get(key) != new.get(key)]
+    recipes = []
+    for key in changed:
+        if key.startswith('repo:'):
+            recipes.extend(LAYER_RECIPES)
+        elif key.startswith('srcrev:'):
+            recipes.extend(INGREDIENT_RECIPES.get(key.split(':', 1)[1], []))
+    return False, 'conf' in changed, sorted(set(recipes))
+
+
+class build_combo:
+    '''One machine/image/target combination and the pipeline steps that build it.'''
+
+    def __init__(self, cfg: dict, args: argparse.Namespace, machine: str, image: str, target: str,
+                 images_dir: Path, local_cfg: dict = None, **ctx_extra):
+        self.cfg = cfg
+        # local: as written in the yaml file, before host specific values were added
+        self.local_cfg = cfg.get('local', {}) if local_cfg is None else local_cfg
+        self.args = args
+        self.target = target
+        self.name = f'{machine}-{image}'
+        self.images_dir = images_dir
+        self.rootfs_dir = args.build_dir.joinpath(f'{machine}-{image}-rootfs')
+        self.ctx = {'machine': machine,
+                    'image': image,
+                    'target': target,
+                    'build_dir': str(args.build_dir.absolute()),
+                    **ctx_extra}
+        self.vab_dir = Path(args.build_dir, self.ctx.get('vab_dir', 'vab')).absolute()
+        self.bb = None
+        self.lock = threading.Lock()
+        self.cache_hit = False
+        self.packager = None
+
+    def bitbaker(self, repos: dict) -> bitbaker:
+        with self.lock:
+            if self.bb is None:
+                self.bb = bitbaker(repos['poky'].srcdir, self.rootfs_dir, self.args.build_dir,
+                                   repos.values())
+                if self.args.bb_session or self.cfg.get('bitbake_session', False):
+                    # make sure the resident server is stopped however the run ends
+                    atexit.register(self.bb.close)
+                    self.bb.start_session(self.args.bb_server_timeout)
+        return self.bb
+
+    def images(self) -> list:
+        if self.args.skip_build:
+            return []
+        if self.args.vab:
+            return FIT_IMAGES + VAB_IMAGES
+        return FIT_IMAGES if self.cfg.get('fit', False) else []
+
+    def cache_key(self, repos: dict, srcrevs: dict) -> str:
+        '''Digest of everything the images of this combination depend on.'''
+        ctx = {key: self.ctx[key] for key in ['machine', 'image', 'target']}
+        data = {'fingerprint': get_fingerprint({**self.cfg, 'local': self.local_cfg}, repos, srcrevs,
+                                               ctx, self.args),
+                'target': self.target,
+                'images': self.images()}
+        if self.args.vab:
+            conf_dir = Path(self.args.conf.name).absolute().parent
+            keys = {}
+            for key in ['root-public-qky', 'root-private-pem', 'root-public-pem']:
+                key_file = conf_dir.joinpath('vab', str(self.cfg.get(key)))
+                keys[key] = sha256sum(key_file) if key_file.is_file() else None
+            data['vab'] = {'keys': keys,
+                           'uboot-dtb': self.cfg.get('uboot-dtb'),
+                           'linux-binary': self.cfg.get('linux-binary'),
+                           'fcs_prepare': repos['fcs_prepare'].revision()}
+        return artifact_cache.key(data)
+
+    def restore(self, cache: artifact_cache, repos: dict, srcrevs: dict):
+        key = self.cache_key(repos, srcrevs)
+        self.cache_hit = cache.restore(key, self.images_dir, self.images())
+        if self.cache_hit:
+            LOG.info(f'{self.name}: images restored from the artifact cache, not building')
+
+    def store(self, cache: artifact_cache, repos: dict, srcrevs: dict):
+        if not self.cache_hit:
+            cache.store(self.cache_key(repos, srcrevs), self.images_dir, self.images(),
+                        {**self.ctx, 'host': os.uname().nodename})
+
+    def configure(self, repos: dict, srcrevs: dict):
+        if self.cache_hit:
+            return
+        cfg, args = self.cfg, self.args
+        rootfs_dir, images_dir = self.rootfs_dir, self.images_dir
+        cleanup = 'none' if args.no_cleanup else args.cleanup or cfg.get('cleanup', 'full')
+        if cleanup == 'full':
+            cmd = YOCTO_CLEANUP.format(rootfs_dir=rootfs_dir,
+                                       images_dir=images_dir)
+            LOG.info(f'cleaning up with commands:\n{cmd}')
+            TRACE.call(['/bin/bash', '-c', cmd])
+
+        clean_recipes = []
+        if cleanup == 'smart':
+            fingerprint_file = state_dir(args).joinpath(f'{rootfs_dir.name}-fingerprint.json')
+            old_fingerprint = {}
+            if fingerprint_file.exists():
+                with fingerprint_file.open('r') as fp:
+                    old_fingerprint = json.load(fp)
+            fingerprint = get_fingerprint(cfg, repos, srcrevs, self.ctx, args)
+            full, conf, clean_recipes = plan_cleanup(old_fingerprint, fingerprint)
+            if full:
+                cmd = YOCTO_CLEANUP.format(rootfs_dir=rootfs_dir, images_dir=images_dir)
+            elif conf or clean_recipes:
+                cmd = f'rm -rf {images_dir}/*'
+                if conf:
+                    cmd = f'rm -rf {rootfs_dir}/conf\n{cmd}'
+            else:
+                cmd = None
+                LOG.info('nothing changed since the last build, not cleaning')
+            if cmd:
+                LOG.info(f'cleaning up with commands:\n{cmd}')
+                TRACE.call(['/bin/bash', '-c', cmd])
+
+        bb = self.bitbaker(repos)
+        with TRACE.span('initialize', rootfs=rootfs_dir.name):
+            bb.initialize(cfg, args, self.ctx)
+        if clean_recipes:
+            LOG.info(f'cleaning recipes affected by changes: {" ".join(clean_recipes)}')
+            with TRACE.span('cleanall', rootfs=rootfs_dir.name):
+                bb.run_step('cleanall', *[f'bitbake {recipe} -c cleanall' for recipe in clean_recipes])
+        if cleanup == 'smart':
+            with fingerprint_file.open('w') as fp:
+                json.dump(fingerprint, fp, indent=2)
+
+    def fetch(self, repos: dict, mirror: premirror = None):
+        if self.cache_hit or self.args.skip_build:
+            return
+        bb = self.bitbaker(repos)
+        try:
+            with TRACE.span('fetch', rootfs=self.rootfs_dir.name, target=self.target):
+                bb.fetch(self.target)
+        except subprocess.SubprocessError as err:
+            raise SystemExit(err)
+        if mirror is not None and mirror.refresh:
+            mirror.update(bb.get_target_env(self.target, ['DL_DIR'])['DL_DIR'])
+
+    def build(self, repos: dict):
+        if self.cache_hit or self.args.skip_build:
+            return
+        rootfs_dir = self.rootfs_dir
+        bb = self.bitbaker(repos)
+        build_start = time.time()
+        try:
+            with TRACE.span('bitbake', rootfs=rootfs_dir.name, target=self.target):
+                bb.build(self.target)
+        except subprocess.SubprocessError as err:
+            raise SystemExit(err)
+        finally:
+            TRACE.add_buildstats(rootfs_dir.joinpath('tmp'), build_start, f'bitbake {rootfs_dir.name}')
+
+    def fit(self, repos: dict) -> list:
+        if self.cache_hit:
+            return [str(self.images_dir.joinpath(f)) for f in FIT_IMAGES]
+        if not self.images_dir.exists():
+            self.images_dir.mkdir()
+        try:
+            itb, spl = self.bitbaker(repos).make_fit(self.target, self.ctx)
+        except subprocess.SubprocessError as err:
+            raise SystemExit(err)
+        images = [STAGER.stage(itb, self.images_dir), STAGER.stage(spl, self.images_dir)]
+        self.package(images)
+        return [str(image) for image in images]
+
+    def vab(self, repos: dict):
+        if self.cache_hit:
+            return [str(self.images_dir.joinpath(f)) for f in VAB_IMAGES]
+        try:
+            built = self.bitbaker(repos).vab(self.cfg, repos, self.ctx, self.args, self.target,
+                                             self.images_dir)
+        except subprocess.SubprocessError as err:
+            raise SystemExit(err)
+        images = [self.images_dir.joinpath(f) for f in VAB_IMAGES]
+        # bitbaker.vab returns False or -1 when quartus_sign or a key is missing
+        if built is not True or not all(image.exists() for image in images):
+            raise SystemExit(f'{self.name}: VAB images were not built')
+        self.package(images + sorted(self.vab_dir.glob('signed-*')))
+        return [str(image) for image in images]
+
+    def package(self, paths: list):
+        if self.packager is None:
+            return
+        for path in paths:
+            path = Path(path)
+            folder = 'vab' if path.parent == self.vab_dir else self.images_dir.name
+            self.packager.add(path, f'{folder}/{path.name}')
+
+    def finish_package(self, repos: dict, srcrevs: dict) -> str:
+        self.packager.info.update({'repos': {name: repo.head() for name, repo in repos.items()},
+                                   'srcrevs': srcrevs})
+        # only the images of this build, restored from the cache or made in an earlier run
+        self.package([self.images_dir.joinpath(f) for f in self.images()
+                      if self.images_dir.joinpath(f).exists()])
+        if self.cache_hit:
+            # the cache holds the images only, vab/ may be from another build
+            self.packager.info['vab'] = 'not packaged, images restored from the artifact cache'
+        elif self.args.vab and self.vab_dir.exists():
+            self.package(sorted(self.vab_dir.glob('signed-*')))
+        return str(self.packager.close())
+
+    def add_steps(self, pipe: pipeline, repos: dict, deps: list, suffix: str = '',
+                  cache: artifact_cache = None, prefetch: bool = False, mirror: premirror = None):
+        cfg, args = self.cfg, self.args
+
+        def srcrevs():
+            return pipe.results['update_meta']
+
+        def build_inputs():
+            return [get_fingerprint(cfg, repos, srcrevs(), self.ctx, args), args.skip_build, self.cache_hit]
+
+        if cache is not None and self.images():
+            restore = f'restore{suffix}'
+            pipe.add(restore, lambda: self.restore(cache, repos, srcrevs()), deps=deps, always=True)
+            deps = [restore]
+        configure = f'configure{suffix}'
+        pipe.add(configure, lambda: self.configure(repos, srcrevs()),
+                 deps=deps,
+                 inputs=build_inputs,
+                 outputs=[self.rootfs_dir.joinpath('conf', 'local.conf')])
+        deps = [configure]
+        if prefetch:
+            # not in the bitbake group, so it downloads while other combinations build
+            fetch = f'fetch{suffix}'
+            pipe.add(fetch, lambda: self.fetch(repos, mirror), deps=deps, inputs=build_inputs)
+            deps = [fetch]
+        build = f'build{suffix}'
+        pipe.add(build, lambda: self.build(repos),
+                 deps=deps,
+                 inputs=build_inputs,
+                 outputs=[self.rootfs_dir.joinpath('conf', 'local.conf')],
+                 group='bitbake')
+        if not self.images():
+            return
+        fit = f'make_fit{suffix}'
+        pipe.add(fit, lambda: self.fit(repos), deps=[build],
+                 inputs=lambda: [self.ctx, str(self.images_dir), self.cache_hit],
+                 outputs=[self.images_dir.joinpath(f) for f in FIT_IMAGES])
+        last = fit
+        if args.vab:
+            vab_keys = ['uboot-dtb', 'linux-binary', 'root-public-qky', 'root-private-pem',
+                        'root-public-pem', 'vab-incremental']
+            last = f'vab{suffix}'
+            pipe.add(last, lambda: self.vab(repos), deps=[fit, 'fcs_prepare'],
+                     inputs=lambda: [{k: cfg.get(k) for k in vab_keys}, str(args.quartus),
+                                     args.vab_incremental, self.cache_hit],
+                     outputs=[self.images_dir.joinpath(f) for f in VAB_IMAGES])
+        if cache is not None:
+            pipe.add(f'store{suffix}', lambda: self.store(cache, repos, srcrevs()), deps=[last],
+                     always=True)
+        if self.packager is not None:
+            pipe.add(f'package{suffix}', lambda: self.finish_package(repos, srcrevs()), deps=[last],
+                     outputs=[self.packager.path])
+
+
+# images make_fit and vab leave in images_dir
+FIT_IMAGES = ['u-boot.itb', 'u-boot-spl-dtb.hex']
+VAB_IMAGES = ['u-boot-vab.itb', 'u-boot-spl-dtb-vab.hex']
+
+
+def set_local_defaults(cfg: dict, values: dict) -> dict:
+    '''Add values to cfg['local']['values'] unless set there already, returns the local values.'''
+    local_values = cfg.setdefault('local', {}).setdefault('values', {})
+    for key, value in values.items():
+        local_values.setdefault(key, value)
+    return local_values
+
+
+def matrix_combos(cfg: dict, args: argparse.Namespace, model: resource_model = None,
+                  local_cfg: dict = None) -> list:
+    '''Make a build_combo for every machine/image/target listed under matrix:.'''
+    combos = cfg.get('matrix', [])
+    jobs = max(1, min(args.matrix_jobs or len(combos), len(combos)))
+
+    # SSTATE_DIR and the hash equivalence server are set up by setup_sstate()
+    shared = {'DL_DIR': '$build_dir/downloads'}
+    ctx_extra = {}
+    if model is not None:
+        shared.update(model.local_values(jobs))
+        ctx_extra['make_jobs'] = model.tune(jobs)['jobs']
+    else:
+        threads = max(1, len(os.sched_getaffinity(0)) // jobs)
+        shared.update({'BB_NUMBER_THREADS': str(threads), 'PARALLEL_MAKE': f'-j {threads}'})
+
+    LOG.info(f'building {len(combos)} combinations, {jobs} at a time with '
+             f'{shared["BB_NUMBER_THREADS"]} threads each')
+    builds = []
+    for combo in combos:
+        combo_cfg = copy.deepcopy(cfg)
+        set_local_defaults(combo_cfg, shared)
+        machine, image, target = combo['machine'], combo['image'], combo['target']
+        name = f'{machine}-{image}'
+        builds.append(build_combo(combo_cfg, args, machine, image, target,
+                                  args.build_dir.joinpath(f'{name}-images'),
+                                  local_cfg, vab_dir=f'{name}-vab', uboot_vab_dir=f'{name}-uboot-vab',
+                                  **ctx_extra))
+    return builds
+
+
+def build_pipeline(cfg: dict, args: argparse.Namespace, repos: dict, sync_jobs: list,
+                   combos: list, server: hashserv = None, mirror: premirror = None) -> pipeline:
+    '''Lay out the steps of a run.'''
+    pipe = pipeline(state_dir(args).joinpath('pipeline.json'),
+                    resume=args.resume, from_step=args.from_step)
+
+    def patches():
+        patch_files = [find_patch(r['patch'], args) for r in cfg.get('repos', []) if r.get('patch')]
+        return [sha256sum(p) if p else None for p in patch_files]
+
+    pipe.add('sync', lambda: sync_repos(repos, sync_jobs, cfg, args),
+             inputs=lambda: [cfg.get('repos'), args.keep, patches()],
+             outputs=[repo.srcdir for repo in repos.values()])
+    pipe.add('update_meta', lambda: update_meta(cfg, repos, args), deps=['sync'],
+             inputs=lambda: [cfg.get('ingredients'), args.pinned,
+                             sha256sum(args.lockfile) if args.pinned else None])
+    if args.vab and not args.skip_build:
+        fcs_prepare = repos.get('fcs_prepare')
+        if fcs_prepare is None:
+            raise SystemExit('No fcs_prepare repo specified')
+        pipe.add('fcs_prepare', lambda: build_fcs_prepare(fcs_prepare), deps=['sync'],
+                 inputs=lambda: fcs_prepare.revision(),
+                 outputs=[fcs_prepare.srcdir.joinpath('fcs_prepare')])
+    build_deps = ['update_meta']
+    if server is not None:
+        # the server runs from the poky checkout, so it can only start once that is synced
+        pipe.add('hashserv', server.start, deps=['sync'], always=True)
+        build_deps.append('hashserv')
+    pipe.limit('bitbake', (args.matrix_jobs or len(combos)) if args.matrix else 1)
+    cache = None
+    cache_cfg = cfg.get('artifact_cache', {})
+    cache_dir = args.artifact_cache or cache_cfg.get('dir')
+    if cache_dir and not args.no_artifact_cache:
+        max_size = args.artifact_cache_size or cache_cfg.get('max_size')
+        cache = artifact_cache(cache_dir, parse_size(max_size) if max_size else None)
+    prefetch = args.prefetch or cfg.get('prefetch', False) or (mirror is not None and mirror.refresh)
+    package_cfg = cfg.get('package', {})
+    compression = args.package or package_cfg.get('compression')
+    package_dir = Path(args.package_dir or package_cfg.get('dir') or args.build_dir)
+    for combo in combos:
+        if compression:
+            combo.packager = image_packager(package_dir.joinpath(f'{combo.name}-{combo.target}'),
+                                            compression, package_cfg.get('level'), dict(combo.ctx))
+        combo.add_steps(pipe, repos, build_deps, f':{combo.name}' if args.matrix else '', cache,
+                        prefetch, mirror)
+    return pipe
+
+
+def setup_sstate(cfg: dict, args: argparse.Namespace, poky: git_repo, shared: bool):
+    '''Wire a host-local sstate cache and a hash equivalence server into local.conf.
+
+    Returns the hashserv, which the caller must start and stop, or None.
+    '''
+    sstate_cfg = cfg.get('sstate', {})
+    sstate_dir = args.sstate_dir or sstate_cfg.get('dir')
+    mirrors = args.sstate_mirror or sstate_cfg.get('mirrors', [])
+    use_hashserv = args.hashserv or sstate_cfg.get('hashserv', False) or shared
+    values = {}
+    if sstate_dir:
+        sstate_dir = Path(sstate_dir).expanduser().absolute()
+        sstate_dir.mkdir(parents=True, exist_ok=True)
+        values['SSTATE_DIR'] = str(sstate_dir)
+    elif shared:
+        values['SSTATE_DIR'] = '$build_dir/sstate-cache'
+    if mirrors:
+        entries = []
+        for m in mirrors:
+            m = m.rstrip('/') if '://' in m else f'file://{Path(m).absolute()}'
+            # remote mirrors need the file name spelled out, file:// ones find it from PATH
+            entries.append(f'file://.* {m}/PATH' + ('' if m.startswith('file://') else ';downloadfilename=PATH'))
+        values['SSTATE_MIRRORS'] = ' '.join(entries)
+
+    server = None
+    if use_hashserv:
+        db_dir = sstate_dir if sstate_dir else state_dir(args)
+        server = hashserv(poky.srcdir,
+                          args.build_dir.joinpath('hashserve.sock'),
+                          db_dir.joinpath('hashserv.db'))
+        atexit.register(server.stop)
+        values['BB_SIGNATURE_HANDLER'] = 'OEEquivHash'
+        values['BB_HASHSERVE'] = server.address
+
+    set_local_defaults(cfg, values)
+    return server
+
+
+def setup_fetch(cfg: dict, args: argparse.Namespace) -> premirror:
+    '''Point bitbake at a premirror and cut it off from the network if asked, returns the premirror.'''
+    mirror_cfg = cfg.get('premirror', {})
+    url = args.premirror or mirror_cfg.get('url')
+    refresh = args.premirror_refresh or mirror_cfg.get('refresh', False)
+    offline = args.offline or mirror_cfg.get('offline', False)
+    values = {}
+    mirror = None
+    if url:
+        mirror = premirror(str(url), refresh)
+        values.update(mirror.local_values())
+    elif refresh:
+        raise SystemExit('--premirror-refresh needs a premirror')
+    if offline:
+        values['BB_NO_NETWORK'] = '1'
+        if mirror is not None:
+            values['BB_FETCH_PREMIRRORONLY'] = '1'
+
+    set_local_defaults(cfg, values)
+    return mirror
+
+
+SSTATE_SUMMARY_RE = re.compile(r'Sstate summary: Wanted (?P<wanted>\d+) (?P<counts>.*?) \(')
+
+
+def sstate_summary(rootfs_dir: Path) -> dict:
+    '''Counts from the last "Sstate summary" line bitbake logged in rootfs_dir.'''
+    summary = {}
+    for log in rootfs_dir.glob('tmp/log/cooker/*/console-latest.log'):
+        for m in SSTATE_SUMMARY_RE.finditer(log.read_text(errors='replace')):
+            summary = {'wanted': int(m.group('wanted'))}
+            for name, count in re.findall(r'(\w+) (\d+)', m.group('counts')):
+                summary[name.lower()] = int(count)
+    return summary
+
+
+def report_sstate(rootfs_dirs: list):
+    for rootfs_dir in rootfs_dirs:
+        summary = sstate_summary(rootfs_dir)
+        if not summary.get('wanted'):
+            continue
+        # hardknott reports Found, newer bitbake reports Local/Network/Mirrors
+        hits = summary.get('found', 0) + sum(summary.get(k, 0) for k in ['local', 'network', 'mirrors'])
+        misses = summary.get('missed', 0)
+        LOG.info(f'sstate {rootfs_dir.name}: wanted {summary["wanted"]}, '
+                 f'{hits} hits ({100 * hits // summary["wanted"]}%), {misses} misses')
+
+
+def setup_footprint(cfg: dict, args: argparse.Namespace):
+    '''Have bitbake remove work dirs with rm_work, keeping the ones meta-bake reads.'''
+    footprint_cfg = cfg.get('footprint', {})
+    if not (args.rm_work or footprint_cfg.get('rm_work', False)):
+        return
+    bootloader = cfg.get('local', {}).get('values', {}).get('PREFERRED_PROVIDER_virtual/bootloader',
+                                                            'u-boot-socfpga')
+    exclude = [bootloader] + footprint_cfg.get('rm_work_exclude', [])
+    local_values = set_local_defaults(cfg, {'INHERIT': '+=rm_work',
+                                            'RM_WORK_EXCLUDE': '+=' + ' '.join(exclude)})
+    if 'rm_work' not in str(local_values['INHERIT']):
+        LOG.warning('INHERIT is set in local.values without rm_work, not removing work dirs')
+
+
+def disk_usage(path: Path) -> int:
+    '''Bytes allocated under path, counting hardlinked files once.'''
+    seen = set()
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def dedup_roots(build_dir: Path) -> list:
+    '''Directories of finished artifacts, which are replaced rather than modified in place.'''
+    roots = list(build_dir.glob('*-images')) + list(build_dir.glob('*-rootfs/tmp/deploy/images'))
+    roots += [p for p in build_dir.glob('*vab') if p.name == 'vab' or
+              (p.name.endswith('-vab') and not p.name.endswith('-uboot-vab'))]
+    return [p for p in roots if p.is_dir()]
+
+
+def dedup_files(roots: list, min_size: int = 4096) -> int:
+    '''Hardlink identical files under roots to one another, returns the bytes freed.'''
+    candidates = {}
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = Path(dirpath, name)
+                if name.startswith('.') and name.endswith('.dedup'):
+                    # left behind by an interrupted run
+                    path.unlink()
+                    continue
+                st = os.lstat(path)
+                if not path.is_symlink() and st.st_size >= min_size:
+                    # only files that can be linked and look the same once they are
+                    key = (st.st_dev, st.st_size, st.st_mode, st.st_uid, st.st_gid)
+                    inode = candidates.setdefault(key, {}).setdefault(st.st_ino, {'nlink': st.st_nlink,
+                                                                                  'paths': []})
+                    inode['paths'].append(path)
+    freed = 0
+    for (_, size, _, _, _), inodes in candidates.items():
+        # an inode with links outside the roots is shared with something else
+        # (e.g. files staged with link=True), so it is neither kept nor replaced
+        inodes = [i for i in inodes.values() if len(i['paths']) == i['nlink']]
+        if len(inodes) < 2:
+            continue
+        by_digest = {}
+        for inode in inodes:
+            by_digest.setdefault(sha256sum(inode['paths'][0]), []).append(inode)
+        for same in by_digest.values():
+            keep = same[0]['paths'][0]
+            for inode in same[1:]:
+                for path in inode['paths']:
+                    tmp = path.with_name(f'.{path.name}.dedup')
+                    tmp.unlink(missing_ok=True)
+                    os.link(keep, tmp)
+                    os.rename(tmp, path)
+                freed += size
+    return freed
+
+
+# DATETIME bitbake puts in the names of the image files it deploys
+DEPLOY_TIMESTAMP_RE = re.compile(r'\d{14}')
+
+
+def prune(cfg: dict, args: argparse.Namespace, budget: int, dry_run: bool = False):
+    '''Bring the build dir, and an sstate cache outside it, under budget bytes.'''
+    build_dir = args.build_dir.absolute()
+    if not dry_run:
+        freed = dedup_files(dedup_roots(build_dir))
+        LOG.info(f'hardlinking identical artifacts freed {freed >> 20} MiB')
+
+    sstate_dirs = list(build_dir.glob('*-rootfs/sstate-cache')) + [build_dir.joinpath('sstate-cache')]
+    measured = [build_dir]
+    shared_sstate = args.sstate_dir or cfg.get('sstate', {}).get('dir')
+    if shared_sstate:
+        shared_sstate = Path(shared_sstate).expanduser().absolute()
+        sstate_dirs.append(shared_sstate)
+        if build_dir not in shared_sstate.parents and shared_sstate.is_dir():
+            measured.append(shared_sstate)
+    total = sum(disk_usage(p) for p in measured)
+    LOG.info(f'{total >> 20} MiB used in {", ".join(str(p) for p in measured)}, budget {budget >> 20} MiB')
+
+    current = {f'{c["machine"]}-{c["image"]}' for c in cfg.get('matrix', [])}
+    machine, image = args.machine or cfg.get('machine'), args.image or cfg.get('image')
+    if machine and image:
+        current.add(f'{machine}-{image}')
+
+    # (order, last used, path)
+    candidates = []
+    for deploy in build_dir.glob('*-rootfs/tmp/deploy/images/*'):
+        linked = {p.resolve() for p in deploy.iterdir() if p.is_symlink()}
+        for path in deploy.iterdir():
+            if (not path.is_symlink() and path.is_file() and DEPLOY_TIMESTAMP_RE.search(path.name)
+                    and path.resolve() not in linked):
+                candidates.append((0, path.stat().st_mtime, path))
+    if not current:
+        LOG.warning('no machine/image or matrix in cfg, not removing any build trees')
+    for rootfs_dir in build_dir.glob('*-rootfs'):
+        name = rootfs_dir.name[:-len('-rootfs')]
+        if not current or name in current:
+            continue
+        for suffix in ['rootfs', 'images', 'vab', 'uboot-vab']:
+            path = build_dir.joinpath(f'{name}-{suffix}')
+            if path.exists():
+                candidates.append((1, rootfs_dir.stat().st_mtime, path))
+    for sstate_dir in sstate_dirs:
+        for dirpath, _, filenames in os.walk(sstate_dir):
+            for name in filenames:
+                # leave hashserv.db and anything else that is not an sstate object
+                if not name.startswith('sstate:') and not name.endswith('.siginfo'):
+                    continue
+                st = os.lstat(os.path.join(dirpath, name))
+                candidates.append((2, max(st.st_atime, st.st_mtime), Path(dirpath, name)))
+
+    removed = {0: [0, 0], 1: [0, 0], 2: [0, 0]}
+    for order, _, path in sorted(candidates, key=lambda c: c[:2]):
+        if total <= budget:
+            break
+        if not os.path.lexists(path):
+            # inside a build tree that was removed already
+            continue
+        if path.is_dir() and not path.is_symlink():
+            size = disk_usage(path)
+            LOG.info(f'{"would remove" if dry_run else "removing"} {path} ({size >> 20} MiB)')
+            if not dry_run:
+                shutil.rmtree(path)
+                state_dir(args).joinpath(f'{path.name}-fingerprint.json').unlink(missing_ok=True)
+        else:
+            st = path.lstat()
+            # other links keep the data allocated
+            size = st.st_blocks * 512 if st.st_nlink == 1 else 0
+            LOG.debug(f'{"would remove" if dry_run else "removing"} {path}')
+            if not dry_run:
+                path.unlink()
+        removed[order][0] += 1
+        removed[order][1] += size
+        total -= size
+
+    for order, what in enumerate(['old deployed images', 'stale build trees', 'sstate objects']):
+        count, size = removed[order]
+        if count:
+            LOG.info(f'  {what:<32} {count:8} {size >> 20:8} MiB')
+    if total > budget:
+        LOG.warning(f'{total >> 20} MiB still used, nothing left to prune')
 
 
 IMAGE_TYPES = ['gsrd', 'nand', 'pcie', 'pr', 'qspi', 'sgmii', 'tse', 'n6000']
@@ -521,86 +2738,188 @@ def main():
     parser.add_argument('build_dir', default='build', type=Path)
     parser.add_argument('--conf', type=argparse.FileType('r'), default='layers.yaml')
     parser.add_argument('--keep', nargs='+', default=[])
+    parser.add_argument('--sync-jobs', type=int, default=None,
+                        help='number of repos to clone/update concurrently')
+    parser.add_argument('--git-mirror', type=Path, default=None,
+                        help='directory of shared bare mirrors to clone repos from')
+    parser.add_argument('--mirror-refresh', type=int, default=None,
+                        help='seconds before a git mirror is fetched again')
+    parser.add_argument('--ref-ttl', type=int, default=600,
+                        help='seconds to cache resolved ingredient branches')
+    parser.add_argument('--lockfile', type=Path, default=None,
+                        help='file to record resolved ingredient hashes in')
+    parser.add_argument('--pinned', action='store_true', default=False,
+                        help='use the hashes in --lockfile instead of resolving branches')
     parser.add_argument('--no-cleanup', action='store_true', default=False)
+    parser.add_argument('--cleanup', choices=['full', 'smart', 'none'], default=None,
+                        help='full wipes TMPDIR and conf every run, smart only cleans what changed')
     parser.add_argument('--machine', choices=MACHINES, default=None)
     parser.add_argument('--image', choices=IMAGE_TYPES, default=None)
     parser.add_argument('--target', default=None)
     parser.add_argument('--images-dir', type=Path)
+    parser.add_argument('--matrix', action='store_true', default=False,
+                        help='build all machine/image/target combinations listed under matrix in cfg')
+    parser.add_argument('--matrix-jobs', type=int, default=None,
+                        help='number of matrix combinations to build concurrently')
     parser.add_argument('--skip-build', action='store_true', default=False)
     parser.add_argument('--quartus', type=Path)
     parser.add_argument('--vab', action='store_true', default=False)
+    parser.add_argument('--sign-jobs', type=int, default=4,
+                        help='number of binaries to sign concurrently for VAB')
+    parser.add_argument('--sign-cache', type=Path, default=None,
+                        help='directory of previously signed binaries (default build/.meta-bake/sign-cache)')
+    parser.add_argument('--no-sign-cache', action='store_true', default=False,
+                        help='always sign every binary')
+    parser.add_argument('--vab-incremental', action='store_true', default=False,
+                        help='build VAB u-boot incrementally out of tree instead of from a fresh copy')
+    parser.add_argument('--no-ccache', action='store_true', default=False,
+                        help='do not use ccache for the incremental VAB u-boot build')
+    parser.add_argument('--sstate-dir', type=Path, default=None,
+                        help='host-local sstate cache shared by all build dirs')
+    parser.add_argument('--sstate-mirror', action='append', default=None,
+                        help='sstate mirror url (file:// or http://), may be repeated')
+    parser.add_argument('--hashserv', action='store_true', default=False,
+                        help='run a local bitbake-hashserv for the duration of the build')
+    parser.add_argument('--bb-session', action='store_true', default=False,
+                        help='keep one sourced environment and bitbake server for the whole run')
+    parser.add_argument('--bb-server-timeout', type=int, default=-1,
+                        help='idle seconds before a session bitbake server unloads (-1 never)')
+    parser.add_argument('--log-dir', type=Path,
+                        help='directory for the per-step logs (default build_dir/logs)')
+    parser.add_argument('--step-timeout', type=float,
+                        help='seconds a build step may run before it is stopped')
+    parser.add_argument('--progress-interval', type=float, default=60,
+                        help='seconds between progress reports of running steps')
+    parser.add_argument('--artifact-cache', type=Path, default=None,
+                        help='directory of cached images keyed on their inputs, may be shared by hosts')
+    parser.add_argument('--artifact-cache-size', default=None,
+                        help='size the artifact cache is trimmed to, e.g. 20G (default unbounded)')
+    parser.add_argument('--no-artifact-cache', action='store_true', default=False,
+                        help='always build, even when the artifact cache has the images')
+    parser.add_argument('--package', choices=sorted(image_packager.COMPRESSORS), default=None,
+                        help='package the images and signed binaries into a compressed tar')
+    parser.add_argument('--package-dir', type=Path, default=None,
+                        help='directory to write packages to (default build_dir)')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='skip steps whose inputs did not change since they last completed')
+    parser.add_argument('--from-step', default=None,
+                        help='rerun this step and the ones after it, resuming the ones before')
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help='download the sources of the target in a step of their own before building')
+    parser.add_argument('--premirror', default=None,
+                        help='directory or url of source tarballs to fetch from before upstream')
+    parser.add_argument('--premirror-refresh', action='store_true', default=False,
+                        help='add the tarballs fetched by this build to the (local) premirror')
+    parser.add_argument('--offline', action='store_true', default=False,
+                        help='set BB_NO_NETWORK, fetching only from DL_DIR and the premirror')
+    parser.add_argument('--rm-work', action='store_true', default=False,
+                        help='have bitbake remove work dirs once recipes are built (not the bootloader)')
+    parser.add_argument('--dedup', action='store_true', default=False,
+                        help='hardlink identical images and signed binaries across build dirs after the build')
+    parser.add_argument('--prune', nargs='?', const='', default=None, metavar='SIZE',
+                        help='instead of building, remove old images, stale build trees and sstate '
+                             'until the build dir is under SIZE (default footprint budget in cfg)')
+    parser.add_argument('--prune-dry-run', action='store_true', default=False,
+                        help='with --prune, only log what would be removed')
+    parser.add_argument('--tune', action='store_true', default=False,
+                        help='size bitbake and make parallelism to the cores, memory and disk of the host')
+    parser.add_argument('--trace', type=Path,
+                        help='write a Chrome trace (JSON) of phases and subprocesses to this file')
 
     args = parser.parse_args()
+    if args.pinned and args.lockfile is None:
+        parser.error('--pinned requires --lockfile')
 
     fmt = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s')
     stdout_h = logging.StreamHandler(sys.stdout)
     stdout_h.setFormatter(fmt)
     LOG.setLevel(logging.DEBUG)
     LOG.addHandler(stdout_h)
+    logging.getLogger('asyncio').setLevel(logging.WARNING)
+    # run atexit handlers (resident bitbake servers, hashserv) on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
     if not args.build_dir.exists():
         args.build_dir.mkdir()
     cfg = yaml.safe_load(args.conf)
+    RUNNER.configure(args.log_dir or args.build_dir.joinpath('logs'),
+                     timeout=args.step_timeout or cfg.get('step_timeout'),
+                     progress_interval=args.progress_interval)
+    if args.trace:
+        # written however the run ends so failed builds can be profiled too
+        atexit.register(TRACE.save, args.trace)
+        atexit.register(TRACE.summary)
+
+    if args.prune is not None:
+        budget = args.prune or cfg.get('footprint', {}).get('budget')
+        if not budget:
+            raise SystemExit('--prune needs a size, on the command line or as budget under footprint in cfg')
+        prune(cfg, args, parse_size(budget), args.prune_dry_run)
+        return
 
     machine = args.machine or cfg.get('machine')
-    if machine is None:
+    if machine is None and not args.matrix:
         raise SystemExit('no machine specified in cfg or command line')
 
     image = args.image or cfg.get('image')
-    if image is None:
+    if image is None and not args.matrix:
         raise SystemExit('no image specified in cfg or command line')
 
     target = args.target or cfg.get('target')
-    if target is None:
+    if target is None and not args.matrix:
         raise SystemExit('no target specified in cfg or command line')
 
-    rootfs_dir = args.build_dir.joinpath(f'{machine}-{image}-rootfs')
-    images_dir = args.images_dir or args.build_dir.joinpath(f'{machine}-{image}-images')
-    if not args.no_cleanup:
-        cmd = YOCTO_CLEANUP.format(rootfs_dir=rootfs_dir,
-                                   images_dir=images_dir)
-        LOG.info(f'cleaning up with commands:\n{cmd}')
-        subprocess.call(['/bin/bash', '-c', cmd])
-
-    ctx = {'machine': machine,
-           'image': image,
-           'target': target,
-           'build_dir': str(args.build_dir.absolute())}
-    repos = get_meta(cfg, args)
+    repos, sync_jobs = get_repos(cfg, args)
     poky = repos.get('poky')
     if poky is None:
         LOG.error('No poky repo specified')
         raise SystemExit('No poky repo specified')
-    update_meta(cfg, repos, args)
 
-    bb = bitbaker(poky.srcdir, rootfs_dir, args.build_dir)
-    bb.initialize(cfg, args, ctx)
-    if args.skip_build:
-        raise SystemExit(0)
+    if args.matrix:
+        if not cfg.get('matrix'):
+            raise SystemExit('--matrix given but no matrix in cfg')
+        for combo in cfg['matrix']:
+            if not all(combo.get(key) for key in ['machine', 'image', 'target']):
+                raise SystemExit(f'matrix entry needs machine, image and target: {combo}')
+
+    local_cfg = copy.deepcopy(cfg.get('local', {}))
+    # sstate settings go into cfg before the combos copy it
+    server = setup_sstate(cfg, args, poky, shared=args.matrix)
+    mirror = setup_fetch(cfg, args)
+    setup_footprint(cfg, args)
+    model = None
+    monitor = pressure_monitor()
+    tune_cfg = cfg.get('tune')
+    if args.tune or tune_cfg:
+        model = resource_model(args.build_dir, **(tune_cfg if isinstance(tune_cfg, dict) else {}))
+        model.report()
+    combos = []
     try:
-        bb.build(target)
-    except subprocess.CalledProcessError as err:
-        raise SystemExit(err)
-
-    if not images_dir.exists():
-        images_dir.mkdir()
-    # VAB signing
-    # make fit
-    if not args.vab:
-        if cfg.get('fit', False):
-            itb, spl = bb.make_fit(target, ctx)
-            shutil.copy(itb, images_dir)
-            shutil.copy(spl, images_dir)
-    else:
-        # VAB
-        try:
-            itb, spl = bb.make_fit(target, ctx)
-            shutil.copy(itb, images_dir)
-            shutil.copy(spl, images_dir)
-            bb.vab(cfg, repos, ctx, args, target, images_dir)
-        except subprocess.CalledProcessError as err:
-            raise SystemExit(err)
-
-    # packaging
+        if args.matrix:
+            combos = matrix_combos(cfg, args, model, local_cfg)
+        else:
+            images_dir = args.images_dir or args.build_dir.joinpath(f'{machine}-{image}-images')
+            ctx_extra = {}
+            if model is not None:
+                local_values = set_local_defaults(cfg, model.local_values())
+                ctx_extra['make_jobs'] = model.tune()['jobs']
+                LOG.info(f'building with {local_values["BB_NUMBER_THREADS"]} bitbake threads '
+                         f'and {local_values["PARALLEL_MAKE"]}')
+            combos = [build_combo(cfg, args, machine, image, target, images_dir, local_cfg, **ctx_extra)]
+        if model is not None:
+            monitor.start()
+        build_pipeline(cfg, args, repos, sync_jobs, combos, server, mirror).run()
+    finally:
+        monitor.stop()
+        for combo in combos:
+            if combo.packager is not None:
+                combo.packager.abort()
+        if server is not None:
+            server.stop()
+    report_sstate([combo.rootfs_dir for combo in combos])
+    STAGER.report()
+    if args.dedup or cfg.get('footprint', {}).get('dedup', False):
+        freed = dedup_files(dedup_roots(args.build_dir))
+        LOG.info(f'hardlinking identical artifacts freed {freed >> 20} MiB')
 
 
 if __name__ == '__main__':